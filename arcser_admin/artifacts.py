@@ -0,0 +1,178 @@
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+
+class ArtifactStore:
+    """ Workspace where the sddraft and sd files of the services are created. The store keeps the size and last use of
+    each file and removes the least recently used files of services already uploaded when the quota is exceeded """
+
+    INDEX_FILE = '.arcser_artifacts.json'
+
+    def __init__(self, root, quota_bytes=None, min_free_bytes=None):
+        """
+        :param root: directory of the workspace
+        :param quota_bytes: maximum bytes used by the files of the store, None for no limit
+        :param min_free_bytes: minimum free bytes in the disk of the workspace, None for no limit
+        """
+        self.root = root
+        self.quota_bytes = quota_bytes
+        self.min_free_bytes = min_free_bytes
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self._index_path = os.path.join(root, self.INDEX_FILE)
+        self._index = {}
+        if os.path.exists(self._index_path):
+            with open(self._index_path, 'r') as f:
+                self._index = json.load(f)
+
+    def save(self):
+        """ Write the index of the store. The changes of register and touch are only kept in memory until it is called
+        :return: None
+        """
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        temp_path = self._index_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self._index, f)
+        os.replace(temp_path, self._index_path)
+
+    def prepare(self, service):
+        """ Create the directory of the service and set the paths of its sddraft and sd files
+        :param service: ServiceTransporter instance
+        :return: directory of the service
+        """
+        directory = os.path.join(self.root, service.qualified_name)
+        os.makedirs(directory, exist_ok=True)
+        service.sddraft_file = os.path.join(directory, service.name + '.sddraft')
+        service.sd_file = os.path.join(directory, service.name + '.sd')
+        # The files of a service staged again are in use, they are the last ones to be evicted
+        for path in self.service_artifacts(service):
+            self.touch(path)
+        return directory
+
+    @staticmethod
+    def service_artifacts(service):
+        """ Files created for a service: sddraft, sddraft modified by custom_sddraft_mapservice and sd, also the ones
+        staged for other targets (ServiceTransporter.target_files)
+        :param service: ServiceTransporter instance
+        :return: list of paths
+        """
+        files = []
+        for sddraft_file, sd_file in [(service.sddraft_file, service.sd_file)] + list(service.target_files):
+            if sddraft_file:
+                root, file_name = os.path.split(sddraft_file)
+                files.append(sddraft_file)
+                files.append(os.path.join(root, '{}{}.sddraft'.format(os.path.splitext(file_name)[0], '_d')))
+            if sd_file:
+                files.append(sd_file)
+        return files
+
+    def register(self, path, uploaded=False):
+        """ Add or update a file in the store. The index is not written, see save
+        :param path: path of the file
+        :param uploaded: the file has been uploaded and can be evicted
+        :return: None
+        """
+        if not os.path.exists(path):
+            return
+        with self._lock:
+            stat = os.stat(path)
+            self._index[path] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'last_used': time.time(),
+                                 'uploaded': uploaded}
+
+    def register_services(self, services):
+        """ Add the files of several services (e.g. a group published together) to the store and write the index once.
+        The files can be evicted if the service has been transferred
+        :param services: list of ServiceTransporter
+        :return: None
+        """
+        for service in services:
+            for path in self.service_artifacts(service):
+                self.register(path, uploaded=service.transferred)
+        self.save()
+
+    def touch(self, path):
+        """ Update the last use of a file. The index is not written, see save
+        :param path: path of the file
+        :return: None
+        """
+        with self._lock:
+            if path in self._index:
+                self._index[path]['last_used'] = time.time()
+
+    def expected_bytes(self, services):
+        """ Bytes the files of the services will need when they are staged. The size of the files of a previous run is
+        used when it is in the index, otherwise the size of the source documents packed in the sd (map document or
+        locator files) is doubled for the sddraft and sd files. Map services with targets are staged once for each
+        federated server
+        :param services: list of ServiceTransporter
+        :return: bytes
+        """
+        total = 0
+        reused = []
+        with self._lock:
+            for service in services:
+                known = [p for p in self.service_artifacts(service) if p in self._index]
+                if known:
+                    total += sum(self._index[p]['size'] for p in known)
+                    reused.extend(known)
+                    continue
+                documents = [getattr(service, 'map_doc_path', None)]
+                documents.extend(getattr(service, 'loc_file_path', None) or [])
+                stagings = len(service.targets) if service.type == 'MapServer' and service.targets else 1
+                total += 2 * stagings * sum(os.path.getsize(x) for x in documents if x and os.path.isfile(x))
+        # The files of the previous run are about to be staged again, they are not evicted to make room for them
+        for path in reused:
+            self.touch(path)
+        return total
+
+    def usage(self):
+        """ Bytes used by the files of the store
+        :return: bytes
+        """
+        with self._lock:
+            return sum(x['size'] for x in self._index.values())
+
+    def _over_limit(self, extra_bytes, used):
+        if self.quota_bytes is not None and used + extra_bytes > self.quota_bytes:
+            return True
+        if self.min_free_bytes is not None and shutil.disk_usage(self.root).free - extra_bytes < self.min_free_bytes:
+            return True
+        return False
+
+    def enforce_quota(self, extra_bytes=0):
+        """ Remove the least recently used files of uploaded services until the store is under the quota and the disk
+        has the minimum free space. Files of services not uploaded are never removed. It is called before staging
+        services, with the bytes they need (see expected_bytes), and after registering the new files
+        :param extra_bytes: bytes we need for the next files
+        :return: list of paths removed
+        """
+        removed = []
+        with self._lock:
+            used = sum(x['size'] for x in self._index.values())
+            candidates = sorted([p for p, x in self._index.items() if x['uploaded']],
+                                key=lambda p: self._index[p]['last_used'])
+            for path in candidates:
+                if not self._over_limit(extra_bytes, used):
+                    break
+                try:
+                    if os.path.exists(path):
+                        os.remove(path)
+                    directory = os.path.dirname(path)
+                    if os.path.isdir(directory) and not os.listdir(directory):
+                        os.rmdir(directory)
+                except OSError as e:
+                    logging.warning('Artifact {} not removed: {}'.format(path, str(e)))
+                    continue
+                used -= self._index.pop(path)['size']
+                removed.append(path)
+            if self._over_limit(extra_bytes, used):
+                logging.warning('Artifact store over the limit, only files of services not uploaded remain')
+            self._save()
+        return removed
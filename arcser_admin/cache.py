@@ -0,0 +1,178 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from arcser_admin.helpers import file_checksum
+
+
+MANIFEST_FILE = '.arcser_cache_manifest.json'
+
+
+def is_cached_service(properties):
+    """ Say us if the service is using a map cache (tiles). The properties must be the lowercase version created by
+    regular_dict
+    :param properties: dictionary from service.properties
+    :return: True if the service is cached
+    """
+    service_properties = properties.get('properties', {})
+    return str(service_properties.get('iscached', properties.get('iscached', 'false'))).lower() == 'true'
+
+
+def service_cache_directory(cache_root, folder, service_name):
+    """ Directory of the cache of a service. ArcGIS Server names it folder_service or only service for the root folder
+    :param cache_root: root of the server cache directory (arcgiscache)
+    :param folder: folder of the service in the server, None or '/' for root folder
+    :param service_name: name of the service
+    :return: path of the service cache
+    """
+    name = service_name if not folder or folder == '/' else '{}_{}'.format(folder, service_name)
+    return os.path.join(cache_root, name)
+
+
+def _load_manifest(target_dir):
+    manifest_path = os.path.join(target_dir, MANIFEST_FILE)
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            return json.load(f)
+    return {}
+
+
+def _save_manifest(target_dir, manifest):
+    manifest_path = os.path.join(target_dir, MANIFEST_FILE)
+    temp_path = manifest_path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(temp_path, manifest_path)
+
+
+def _copy_with_checksum(source_file, target_file, algorithm='sha256', chunk_size=1024 * 1024):
+    """ Copy a file by chunks calculating the checksum of the source on the fly
+    :return: hexadecimal digest of the source file
+    """
+    h = hashlib.new(algorithm)
+    with open(source_file, 'rb') as fs, open(target_file, 'wb') as ft:
+        for chunk in iter(lambda: fs.read(chunk_size), b''):
+            h.update(chunk)
+            ft.write(chunk)
+    shutil.copystat(source_file, target_file)
+    return h.hexdigest()
+
+
+def _transfer_file(source_file, target_file, link, verify):
+    """ Copy or hard-link one file of the cache
+    :return: checksum of the file
+    """
+    os.makedirs(os.path.dirname(target_file), exist_ok=True)
+    if os.path.exists(target_file):
+        os.remove(target_file)
+    if link:
+        # The link is the same inode as the source, there is nothing to verify
+        os.link(source_file, target_file)
+        return None
+    checksum = _copy_with_checksum(source_file, target_file)
+    if verify and file_checksum(target_file) != checksum:
+        raise IOError('Checksum mismatch for {}'.format(target_file))
+    return checksum
+
+
+def _is_transferred(entry, source_file, target_file, link):
+    """ Say us if a file of the manifest is still valid in the target: the source has not changed (size and
+    modification time) and the target is the same inode (links) or has the checksum of the copy
+    """
+    if not entry or not os.path.exists(target_file):
+        return False
+    source_stat = os.stat(source_file)
+    if source_stat.st_size != entry['size'] or source_stat.st_mtime != entry.get('mtime'):
+        return False
+    if link:
+        return os.path.samefile(source_file, target_file)
+    return bool(entry.get('checksum')) and os.path.getsize(target_file) == entry['size'] and \
+        file_checksum(target_file) == entry['checksum']
+
+
+def transfer_cache(source_dir, target_dir, workers=8, link=False, verify=True):
+    """ Copy or hard-link the tiles of a cache directory into another one. The files are transferred in parallel. A
+    manifest with size, modification time and checksum of each transferred file is kept in the target directory, so
+    when the process is run again the files already transferred are skipped (resume). A copy is skipped only if its
+    checksum is the one of the manifest, truncated or corrupt files are copied again
+    :param source_dir: cache directory of the service in source server
+    :param target_dir: cache directory of the service in target server
+    :param workers: number of files transferred at the same time
+    :param link: create hard-links instead of copies. Source and target must be in the same volume
+    :param verify: check the checksum of the file written in the target, not used for hard-links
+    :return: tuple with the number of files transferred and list of tuples (file, error) not transferred
+    """
+    if not os.path.isdir(source_dir):
+        return 0, [(source_dir, 'Source cache directory does not exist')]
+    os.makedirs(target_dir, exist_ok=True)
+
+    manifest = _load_manifest(target_dir)
+    pending = []
+    for root, directories, files in os.walk(source_dir):
+        for file in files:
+            source_file = os.path.join(root, file)
+            relative = os.path.relpath(source_file, source_dir)
+            pending.append((relative, source_file, os.path.join(target_dir, relative)))
+
+    lock = threading.Lock()
+    errors = []
+    transferred = [0]
+
+    def work(item):
+        relative, source_file, target_file = item
+        try:
+            # The checksum of the files already in the manifest is checked in the workers too
+            if _is_transferred(manifest.get(relative), source_file, target_file, link):
+                return
+            source_stat = os.stat(source_file)
+            checksum = _transfer_file(source_file, target_file, link, verify)
+        except (IOError, OSError) as e:
+            logging.error('Cache file {} not transferred: {}'.format(relative, str(e)))
+            with lock:
+                errors.append((relative, str(e)))
+        else:
+            with lock:
+                manifest[relative] = {'size': source_stat.st_size, 'mtime': source_stat.st_mtime,
+                                      'checksum': checksum}
+                transferred[0] += 1
+                # Save from time to time so an interrupted transfer can be resumed
+                if transferred[0] % 500 == 0:
+                    _save_manifest(target_dir, manifest)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(work, pending))
+
+    _save_manifest(target_dir, manifest)
+    return transferred[0], errors
+
+
+def processing_cache(service, source_cache_root, target_cache_root, dummy_name='', workers=8, link=False):
+    """ Transfer the map cache of a transferred cached service to the cache directory of the target service. The
+    result is kept in ServiceTransporter.cache_transferred and, if some file is not transferred, a comment is added to
+    ServiceTransporter.transferred_comment
+    :param service: STMapService instance already published
+    :param source_cache_root: cache directory of source server as it is seen from this machine
+    :param target_cache_root: cache directory of target server as it is seen from this machine
+    :param dummy_name: prefix added to the original service name when the service was published
+    :param workers: number of files transferred at the same time
+    :param link: create hard-links instead of copies
+    :return: True if all the tiles have been transferred
+    """
+    if not service.transferred or not is_cached_service(service.properties):
+        return False
+    source_folder = os.path.split(service.qualified_name)[0]
+    source_dir = service_cache_directory(source_cache_root, source_folder, service.name)
+    target_dir = service_cache_directory(target_cache_root, service.folder, dummy_name + service.name)
+
+    count, errors = transfer_cache(source_dir, target_dir, workers, link)
+    logging.debug('Cache of {}: {} files transferred, {} errors'.format(service.qualified_name, count, len(errors)))
+    service.cache_transferred = not errors
+    if errors:
+        comment = 'Cache transfer: {} files not transferred'.format(len(errors))
+        service.transferred_comment = '{}; {}'.format(service.transferred_comment, comment) \
+            if service.transferred_comment else comment
+        return False
+    return True
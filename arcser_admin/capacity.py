@@ -0,0 +1,185 @@
+import logging
+import math
+import xml.dom.minidom as DOM
+from arcser_admin.helpers import target_server, transferred_to
+
+
+# Service properties (admin API names) that define the capacity of a service and the key used for them in the sddraft
+CAPACITY_PROPERTIES = {'minInstancesPerNode': 'MinInstances',
+                       'maxInstancesPerNode': 'MaxInstances',
+                       'instancesPerContainer': 'InstancesPerContainer',
+                       'maxWaitTime': 'WaitTimeout',
+                       'maxStartupTime': 'StartupTimeout',
+                       'maxIdleTime': 'IdleTimeout',
+                       'maxUsageTime': 'UsageTimeout',
+                       'isolationLevel': 'Isolation',
+                       'keepAliveInterval': 'KeepAliveInterval',
+                       'recycleInterval': 'recycleInterval',
+                       'recycleStartTime': 'recycleStartTime',
+                       'provider': 'provider'}
+
+
+def capacity_profile(properties):
+    """ Extract from the service properties the settings of the instance pool (instances per node, timeouts, dedicated
+    or shared instance type and recycle schedule). The properties must be the lowercase version created by
+    regular_dict. Only the settings defined in the properties are included
+    :param properties: dictionary from service.properties
+    :return: dictionary with the capacity settings using the admin API names
+    """
+    profile = {}
+    for key in CAPACITY_PROPERTIES:
+        if properties.get(key.lower()) is not None:
+            profile[key] = properties[key.lower()]
+    return profile
+
+
+def scale_capacity_profile(profile, factor=1.0, max_instances=None, **overrides):
+    """ Create a new capacity profile for a target environment. The instance counts are multiplied by the factor
+    (rounded up) and can be limited by max_instances. The rest of the settings are kept unless they are overridden
+    :param profile: capacity profile as returned by capacity_profile
+    :param factor: factor applied to the minimum and maximum instances per node
+    :param max_instances: maximum instances per node allowed in the target environment
+    :param overrides: settings replaced in the new profile e.g. maxWaitTime=30
+    :return: dictionary with the new capacity profile
+    """
+    scaled = dict(profile)
+    for key in ('minInstancesPerNode', 'maxInstancesPerNode'):
+        if key in scaled:
+            value = int(math.ceil(int(scaled[key]) * factor))
+            if max_instances is not None:
+                value = min(value, max_instances)
+            scaled[key] = value
+    if 'maxInstancesPerNode' in scaled:
+        scaled['maxInstancesPerNode'] = max(scaled['maxInstancesPerNode'], 1)
+        if 'minInstancesPerNode' in scaled:
+            scaled['minInstancesPerNode'] = min(scaled['minInstancesPerNode'], scaled['maxInstancesPerNode'])
+    scaled.update(overrides)
+    return scaled
+
+
+def geoprocessing_settings(properties):
+    """ Get from the service properties the values used to create the sddraft of a geoprocessing service. When a value
+    is not in the properties the default value of the service is used. The properties must be the lowercase version
+    created by regular_dict
+    :param properties: dictionary from service.properties
+    :return: dictionary with the keyword arguments for arcpy.CreateGPSDDraft
+    """
+    # The admin API returns Synchronous or Asynchronous, the esri names are found in old service definitions
+    execution_types = {'synchronous': 'Synchronous', 'asynchronous': 'Asynchronous',
+                       'esriexecutiontypesynchronous': 'Synchronous', 'esriexecutiontypeasynchronous': 'Asynchronous'}
+    show_messages = {'none': 'NONE', 'error': 'ERROR', 'warning': 'WARNING', 'info': 'INFO'}
+
+    gp_properties = properties.get('properties', {})
+    return {'executionType': execution_types.get(str(gp_properties.get('executiontype')).lower(), 'Synchronous'),
+            'resultMapServer': str(gp_properties.get('resultmapserver', 'false')).lower() == 'true',
+            'showMessages': show_messages.get(str(gp_properties.get('showmessages', 'info')).lower(), 'INFO'),
+            'maximumRecords': int(gp_properties.get('maximumrecords', 1000)),
+            'minInstances': int(properties.get('mininstancespernode', 1)),
+            'maxInstances': int(properties.get('maxinstancespernode', 2)),
+            'maxUsageTime': int(properties.get('maxusagetime', 600)),
+            'maxWaitTime': int(properties.get('maxwaittime', 60)),
+            'maxIdleTime': int(properties.get('maxidletime', 1800))}
+
+
+def apply_capacity_profile_sddraft(sddraft_doc, profile):
+    """ Set the capacity settings in the service level properties of the sddraft. The sddraft file is overwritten.
+    The properties of the extensions are not changed
+    :param sddraft_doc: path to sddraft file
+    :param profile: capacity profile as returned by capacity_profile
+    :return: list with the settings of the profile not found in the sddraft
+    """
+    doc = DOM.parse(sddraft_doc)
+    sddraft_keys = {value: key for key, value in CAPACITY_PROPERTIES.items() if key in profile}
+    found = set()
+    for props in doc.getElementsByTagName('Props'):
+        if props.parentNode.tagName != 'Definition':
+            continue
+        for property_key in props.getElementsByTagName('Key'):
+            key = property_key.firstChild.data
+            if key in sddraft_keys:
+                value = property_key.nextSibling
+                if value.hasChildNodes():
+                    value.firstChild.data = str(profile[sddraft_keys[key]])
+                else:
+                    value.appendChild(doc.createTextNode(str(profile[sddraft_keys[key]])))
+                found.add(sddraft_keys[key])
+
+    with open(sddraft_doc, 'w') as f:
+        doc.writexml(f)
+
+    unmatch = [key for key in profile if key not in found]
+    for key in unmatch:
+        logging.warning('Capacity setting {} not in sddraft'.format(key))
+    return unmatch
+
+
+def apply_capacity_profile_server(server_service, profile):
+    """ Apply the capacity settings to a published service through the admin API. Useful for the settings not
+    included in the sddraft
+    :param server_service: arcgis.gis.server.Service instance of the target server
+    :param profile: capacity profile as returned by capacity_profile
+    :return: True if the service has been edited
+    """
+    properties = dict(server_service.properties)
+    properties.update(profile)
+    return server_service.edit(properties)
+
+
+def apply_capacity_profiles_server(server, services, dummy_name='', target=None):
+    """ Apply the capacity profile of each transferred service to the service published in the target server
+    :param server: arcgis.gis.server.Server instance of the target server
+    :param services: list of ServiceTransporter with capacity_profile attribute
+    :param dummy_name: prefix added to the original service name when the service was published
+    :param target: target of ServiceTransporter.targets the server belongs to, only the services uploaded to it are
+    edited. None for services without targets
+    :return: list of qualified names of the services not edited
+    """
+    not_edited = []
+    candidates = [x for x in services if transferred_to(x, target) and getattr(x, 'capacity_profile', None)]
+    if not candidates:
+        return not_edited
+    # The services of the target are listed once and indexed by folder, name and type
+    published = {}
+    for folder in set(x.folder if x.folder else '/' for x in candidates):
+        try:
+            for x in server.services.list(folder, True):
+                published[(folder, x.serviceName, x.type)] = x
+        except Exception as e:
+            logging.error('Services of folder {} not listed: {}'.format(folder, str(e)))
+    for service in candidates:
+        folder = service.folder if service.folder else '/'
+        server_service = published.get((folder, dummy_name + service.name, service.type))
+        try:
+            if server_service is None or not apply_capacity_profile_server(server_service, service.capacity_profile):
+                not_edited.append(service.qualified_name)
+        except Exception as e:
+            logging.error('Capacity profile not applied to {}: {}'.format(service.qualified_name, str(e)))
+            not_edited.append(service.qualified_name)
+    return not_edited
+
+
+def server_key(url):
+    """ Normalized url of a server to compare the urls of the admin API and the ones of the targets
+    :param url: url of the server e.g. https://host:6443/arcgis or https://host:6443/arcgis/admin
+    :return: url in lower case without the admin end point
+    """
+    url = url.lower().rstrip('/')
+    return url[:-len('/admin')] if url.endswith('/admin') else url
+
+
+def target_admin_servers(servers, targets):
+    """ Servers of the target portal matching the targets of the services
+    :param servers: list of arcgis.gis.server.Server instances, e.g. gis.admin.servers.list()
+    :param targets: list of targets of ServiceTransporter.targets
+    :return: dictionary target server: arcgis.gis.server.Server instance. Targets not federated in the portal (e.g.
+    server connection files) are not included
+    """
+    by_url = {server_key(x.url): x for x in servers}
+    result = {}
+    for target in targets:
+        server = target_server(target)
+        if server_key(server) in by_url:
+            result[server] = by_url[server_key(server)]
+        else:
+            logging.warning('Target {} is not a server of the portal'.format(server))
+    return result
@@ -0,0 +1,160 @@
+import arcpy
+import json
+import logging
+import os
+import shutil
+import tempfile
+import uuid
+from arcser_admin.mapx import target_connection_info, mapx_connection_infos
+
+
+DATABASE_PLATFORMS = {'sqlserver': 'SQL_SERVER', 'postgresql': 'POSTGRESQL', 'oracle': 'ORACLE', 'db2': 'DB2',
+                      'informix': 'INFORMIX', 'hana': 'SAP_HANA'}
+
+AUTHENTICATION_MODES = {'DBMS': 'DATABASE_AUTH', 'OSA': 'OPERATING_SYSTEM_AUTH'}
+
+
+def connection_key(connection_info):
+    """ Hashable key of a connection info
+    :param connection_info: dictionary as in arcpy connectionProperties['connection_info']
+    :return: string
+    """
+    return json.dumps(connection_info, sort_keys=True, default=str)
+
+
+def service_target_connections(service):
+    """ Connection infos the service will use in the target environment after services.change_connection. For .mapx
+    documents they are read from the document. For other documents the layers can not be read without importing them,
+    so the source connection of the service (source_data) is used with the same database and version substitution
+    :param service: STMapService instance
+    :return: list of dictionaries, without duplicates. Empty if the connections can not be known
+    """
+    infos = None
+    if service.map_doc_path and service.map_doc_path.lower().endswith('.mapx'):
+        try:
+            infos = [target_connection_info(x, service.target_data)
+                     for x in mapx_connection_infos(service.map_doc_path)]
+        except (OSError, ValueError) as e:
+            logging.warning('Connections of {} not read: {}'.format(service.map_doc_path, str(e)))
+    if infos is None:
+        source_data = getattr(service, 'source_data', None)
+        if not source_data or not source_data.get('connection_info'):
+            logging.debug('Connections of {} not validated, no source connection'.format(service.qualified_name))
+            return []
+        infos = [target_connection_info(source_data['connection_info'], service.target_data)]
+    return list({connection_key(x): x for x in infos}.values())
+
+
+class ConnectionNotValidated(Exception):
+    """ Exception raised by the testers when a connection can not be tested, e.g. only its encrypted password is known
+    """
+
+    def __init__(self, message):
+        super().__init__(message)
+
+
+def test_connection(connection_info, temp_folder):
+    """ Try to connect to an enterprise database and check the version exists. A temporal .sde file is created
+    :param connection_info: dictionary as in arcpy connectionProperties['connection_info']
+    :param temp_folder: folder for the .sde file
+    :return: None if the connection works, otherwise the error message
+    :raise: ConnectionNotValidated if the database user has only the encrypted password, CreateDatabaseConnection
+    needs the plain one
+    """
+    if str(connection_info.get('authentication_mode', 'DBMS')).upper() != 'OSA' and \
+            not connection_info.get('password') and connection_info.get('encrypted_password'):
+        raise ConnectionNotValidated('only the encrypted password of the user {} is known'.format(
+            connection_info.get('user')))
+    dbclient = str(connection_info.get('dbclient', '')).lower()
+    platform = DATABASE_PLATFORMS.get(dbclient, dbclient.upper())
+    instance = connection_info.get('db_connection_properties') or connection_info.get('server')
+    authentication = AUTHENTICATION_MODES.get(str(connection_info.get('authentication_mode', 'DBMS')).upper(),
+                                              'DATABASE_AUTH')
+    version = connection_info.get('version')
+    name = '{}.sde'.format(uuid.uuid4().hex)
+    try:
+        arcpy.management.CreateDatabaseConnection(temp_folder, name, platform, instance, authentication,
+                                                  connection_info.get('user'), connection_info.get('password'),
+                                                  'SAVE_USERNAME', connection_info.get('database'), None,
+                                                  'TRANSACTIONAL' if version else None, version)
+        sde_path = os.path.join(temp_folder, name)
+        if not arcpy.Exists(sde_path):
+            return 'connection file not created'
+        if version and version.lower() not in [x.name.lower() for x in arcpy.da.ListVersions(sde_path)]:
+            return 'version {} does not exist'.format(version)
+    except (arcpy.ExecuteError, arcpy.ExecuteWarning):
+        return arcpy.GetMessages(2)
+    except (RuntimeError, OSError) as e:
+        return str(e)
+    return None
+
+
+class ConnectionValidator:
+    """ Test each distinct target connection of the services once before publishing. The results are kept, so a
+    connection is not tested again in the same process. The connections are tested one by one because arcpy is not
+    thread safe, they are few once the duplicates are removed. Connections that can not be tested are reported as
+    not validated and their services are published anyway """
+
+    def __init__(self, tester=test_connection):
+        """
+        :param tester: function tester(connection_info, temp_folder) returning None or the error message. It raises
+        ConnectionNotValidated when the connection can not be tested
+        """
+        self.tester = tester
+        self._results = {}
+        # Keys of the connections not validated
+        self.not_validated = set()
+
+    def _test(self, key, connection_info, temp_folder):
+        try:
+            return self.tester(connection_info, temp_folder)
+        except ConnectionNotValidated as e:
+            logging.warning('Connection to database {} version {} not validated: {}'.format(
+                connection_info.get('database'), connection_info.get('version'), str(e)))
+            self.not_validated.add(key)
+            return None
+        except Exception as e:
+            return str(e)
+
+    def test(self, connection_infos):
+        """ Test the connections not tested yet
+        :param connection_infos: list of connection infos
+        :return: dictionary connection_key: None if the connection works or is not validated, otherwise the error
+        message
+        """
+        infos = {connection_key(x): x for x in connection_infos}
+        new = {k: v for k, v in infos.items() if k not in self._results}
+        if new:
+            temp_folder = tempfile.mkdtemp(prefix='arcser_connections_')
+            try:
+                for key, info in new.items():
+                    self._results[key] = self._test(key, info, temp_folder)
+            finally:
+                shutil.rmtree(temp_folder, ignore_errors=True)
+        return {k: self._results[k] for k in infos}
+
+    def validate(self, services):
+        """ Validate the target connections of the map services. Services with an unusable connection are marked as
+        not transferred, so no import or staging work is done for them
+        :param services: list of ServiceTransporter, only the MapServer with target_data are validated
+        :return: list of services failed
+        """
+        candidates = [x for x in services if x.transferred and x.type == 'MapServer' and x.target_data]
+        connections = {x.qualified_name: service_target_connections(x) for x in candidates}
+        results = self.test([c for infos in connections.values() for c in infos])
+        failed = []
+        for service in candidates:
+            errors = ['database {} version {}: {}'.format(c.get('database'), c.get('version'),
+                                                          results[connection_key(c)])
+                      for c in connections[service.qualified_name] if results[connection_key(c)]]
+            if errors:
+                service.transferred = False
+                service.transferred_comment = 'Connection validation error: {}'.format(' - '.join(errors))
+                failed.append(service)
+        logging.debug('Connections tested {}, not validated {}, services failed {}'.format(
+            len(results), len(self.not_validated.intersection(results)), len(failed)))
+        return failed
+
+
+# Connection validator of the process
+connection_validator = ConnectionValidator()
@@ -0,0 +1,451 @@
+import collections
+import logging
+import multiprocessing
+import multiprocessing.connection
+import threading
+import time
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def process_usage(pid=None):
+    """ Resident memory and open handles (file descriptors in no Windows systems) of a process. psutil is needed, if it
+    is not installed None is returned for both values
+    :param pid: process id, None for the current process
+    :return: tuple with rss in bytes and number of handles
+    """
+    if psutil is None:
+        return None, None
+    process = psutil.Process(pid)
+    handles = process.num_handles() if hasattr(process, 'num_handles') else process.num_fds()
+    return process.memory_info().rss, handles
+
+
+class WorkerLimits:
+    """ Limits of a worker process. When a worker goes over one of them it is recycled after the current task. The
+    memory and handles limits need psutil """
+
+    def __init__(self, max_rss_bytes=None, max_handles=None, max_tasks=None):
+        """
+        :param max_rss_bytes: maximum resident memory of the worker, psutil is needed
+        :param max_handles: maximum open handles of the worker, psutil is needed
+        :param max_tasks: maximum tasks processed by the worker
+        """
+        self.max_rss_bytes = max_rss_bytes
+        self.max_handles = max_handles
+        self.max_tasks = max_tasks
+        if psutil is None and (max_rss_bytes is not None or max_handles is not None):
+            logging.warning('psutil is not installed, the memory and handles limits of the workers are not applied')
+
+    def exceeded(self, tasks):
+        """ Check the limits in the current process
+        :param tasks: tasks processed by the worker
+        :return: reason of the recycling, None if the limits are not exceeded
+        """
+        if self.max_tasks is not None and tasks >= self.max_tasks:
+            return 'tasks {}'.format(tasks)
+        if self.max_rss_bytes is None and self.max_handles is None:
+            return None
+        rss, handles = process_usage()
+        if rss is not None and self.max_rss_bytes is not None and rss > self.max_rss_bytes:
+            return 'rss {}'.format(rss)
+        if handles is not None and self.max_handles is not None and handles > self.max_handles:
+            return 'handles {}'.format(handles)
+        return None
+
+
+# Channel of the current worker process with the supervisor, see report_stage
+_reporter = {}
+
+
+def _send(kind, task_id, value):
+    """ Send a message to the supervisor through the pipe of the worker. The pipe is shared by the threads of the
+    worker, so the messages are sent one by one """
+    with _reporter['lock']:
+        _reporter['connection'].send((kind, _reporter['worker_id'], task_id, value))
+
+
+def report_stage(name):
+    """ Report to the supervisor the start of a stage of the current task. It is used for the stage timeouts. Outside
+    a worker process nothing is done
+    :param name: name of the stage
+    :return: None
+    """
+    if _reporter:
+        _send('stage', _reporter['task_id'], name)
+
+
+def report_result(value):
+    """ Report to the supervisor the result of a part of the current task (e.g. a service of a group). If the task
+    does not finish (error, timeout or the worker dies) the parts already reported are returned with the error instead
+    of being lost. Outside a worker process nothing is done
+    :param value: picklable result of the part
+    :return: None
+    """
+    if _reporter:
+        _send('partial', _reporter['task_id'], value)
+
+
+def report_hold(name, held):
+    """ Report to the supervisor that the worker has acquired or released a semaphore of WorkerPool.semaphores. If
+    the worker is killed the supervisor releases the semaphores it holds
+    :param name: name of the semaphore
+    :param held: True when it is acquired, False when it is released
+    :return: None
+    """
+    if _reporter:
+        _send('hold', _reporter['task_id'], (name, held))
+
+
+def request_recycle(reason):
+    """ Ask the supervisor to replace the current worker once the current task is finished, e.g. when its state can
+    not be restored for the next task. Outside a worker process nothing is done
+    :param reason: reason of the recycling
+    :return: None
+    """
+    if _reporter:
+        _reporter['recycle'] = reason
+
+
+def _worker_main(worker_id, task_queue, connection, handler, initializer, initargs, finalizer, limits):
+    """ Loop of a worker process. The state returned by the initializer is passed to the handler with each task. The
+    messages are sent to the supervisor through a pipe used only by this worker. If the initializer fails the error is
+    sent instead of 'ready' and the worker ends """
+    _reporter.update({'connection': connection, 'lock': threading.Lock(), 'worker_id': worker_id, 'task_id': None})
+    try:
+        state = initializer(*initargs) if initializer else None
+    except Exception as e:
+        logging.exception('Worker {} initialization error'.format(worker_id))
+        _send('init_error', None, str(e))
+        connection.close()
+        return
+    _send('ready', None, None)
+    tasks = 0
+    try:
+        while True:
+            item = task_queue.get()
+            if item is None:
+                break
+            task_id, task = item
+            _reporter['task_id'] = task_id
+            try:
+                message = ('done', task_id, handler(state, task))
+            except Exception as e:
+                logging.exception('Worker {} task error'.format(worker_id))
+                message = ('error', task_id, 'error: {}'.format(str(e)))
+            tasks += 1
+            reason = _reporter.pop('recycle', None) or (limits.exceeded(tasks) if limits else None)
+            # The parent must know the worker is retiring before it is idle, so no new task is sent to it
+            if reason:
+                _send('recycle', None, reason)
+            _send(*message)
+            if reason:
+                break
+    finally:
+        if finalizer:
+            finalizer(state)
+        connection.close()
+
+
+class WorkerPool:
+    """ Pool of worker processes supervised by the parent process. Tasks are sent one by one to idle workers once they
+    are ready. Workers going over their limits are replaced by new ones and the task of a worker that dies is sent
+    again to a new worker. If a worker can not be initialized no more workers are started and the pending tasks fail.
+    Each worker has its own task queue and result pipe, so a worker killed by the supervisor can not corrupt the
+    messages of the others
+    """
+
+    def __init__(self, processes, handler, initializer=None, initargs=(), finalizer=None, limits=None,
+                 max_requeues=1, stage_timeouts=None, task_timeout=None, semaphores=None, listener=None,
+                 stop_timeout=30, remaining=None):
+        """
+        :param processes: number of worker processes
+        :param handler: function called in the worker as handler(state, task). Must be defined at module level
+        :param initializer: function called when the worker starts, it returns the state of the worker
+        :param initargs: arguments of the initializer
+        :param finalizer: function called with the state when the worker ends
+        :param limits: WorkerLimits instance
+        :param max_requeues: times a task is sent again after its worker dies
+        :param stage_timeouts: dictionary with the maximum seconds of each stage reported with report_stage. The
+        worker is killed when a stage goes over its time and the task finishes with a timeout error
+        :param task_timeout: maximum seconds of a task, None for no limit
+        :param semaphores: dictionary with the multiprocessing semaphores used by the workers with report_hold
+        :param listener: function called in the parent process as listener(event, task_id, value) when a task is going
+        to be sent to a worker ('start', value is the size of the task), starts a stage ('stage', value is the name of
+        the stage) or finishes ('end', value is the error or None)
+        :param stop_timeout: seconds a worker has to exit after it is asked to stop, then it is killed
+        :param remaining: function called in the parent as remaining(task, values) when the worker of a task dies after
+        reporting some parts with report_result. It returns the task with only the parts without a value, which is
+        sent again instead of the whole task. The handler must return the list of values of its parts, the result of
+        the task is the values kept from the dead workers plus the result of the last worker. None to send the whole
+        task again
+        """
+        self.processes = processes
+        self.handler = handler
+        self.initializer = initializer
+        self.initargs = initargs
+        self.finalizer = finalizer
+        self.limits = limits
+        self.max_requeues = max_requeues
+        self.stage_timeouts = stage_timeouts or {}
+        self.task_timeout = task_timeout
+        self.semaphores = semaphores or {}
+        self.listener = listener
+        self.stop_timeout = stop_timeout
+        self.remaining = remaining
+        self._workers = {}
+        self._next_worker_id = 0
+
+    def _start_worker(self):
+        worker_id = self._next_worker_id
+        self._next_worker_id += 1
+        task_queue = multiprocessing.Queue()
+        reader, writer = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=_worker_main,
+                                          args=(worker_id, task_queue, writer, self.handler,
+                                                self.initializer, self.initargs, self.finalizer, self.limits),
+                                          daemon=True)
+        process.start()
+        # Only the worker keeps the writing end, so the reading end gets EOF when the worker exits
+        writer.close()
+        self._workers[worker_id] = {'process': process, 'queue': task_queue, 'connection': reader, 'eof': False,
+                                    'task_id': None, 'started': None, 'stage': None, 'stage_started': None,
+                                    'retiring': False, 'ready': False, 'held': []}
+        return worker_id
+
+    def start(self):
+        """ Start the workers before the tasks are ready, so their initialization (e.g. import arcpy, sign in and open
+        the project) runs while the parent process prepares the tasks
+        :return: None
+        """
+        for _ in range(self.processes - len([w for w in self._workers.values() if not w['retiring']])):
+            self._start_worker()
+
+    def _stop_worker(self, worker_id, kill=False):
+        """ Wait for a worker to exit. It is killed if kill is True (e.g. it is blocked in a task) or if it does not
+        exit in stop_timeout seconds
+        """
+        worker = self._workers.pop(worker_id)
+        if not kill:
+            worker['process'].join(self.stop_timeout)
+        if worker['process'].is_alive():
+            logging.warning('Worker {} killed'.format(worker_id))
+            worker['process'].terminate()
+            worker['process'].join(self.stop_timeout)
+        worker['connection'].close()
+        worker['queue'].close()
+        # Semaphores acquired by a worker that has not finished properly are released
+        for name in worker['held']:
+            try:
+                self.semaphores[name].release()
+            except ValueError:
+                pass
+
+    def _receive(self, timeout):
+        """ Read the messages sent by the workers
+        :param timeout: seconds to wait for a message, 0 to read only the messages already sent
+        :return: list of messages
+        """
+        connections = {w['connection']: k for k, w in self._workers.items() if not w['eof']}
+        messages = []
+        for connection in multiprocessing.connection.wait(list(connections), timeout):
+            try:
+                messages.append(connection.recv())
+            except (EOFError, OSError):
+                # The worker has exited, its pipe is not read any more
+                self._workers[connections[connection]]['eof'] = True
+        return messages
+
+    def _timed_out(self, worker, now):
+        """ Check the time budgets of the task of a worker
+        :return: reason of the timeout, None if the task is in time
+        """
+        if self.task_timeout is not None and now - worker['started'] > self.task_timeout:
+            return 'task exceeded {}s'.format(self.task_timeout)
+        limit = self.stage_timeouts.get(worker['stage'])
+        if limit is not None and now - worker['stage_started'] > limit:
+            return 'stage {} exceeded {}s'.format(worker['stage'], limit)
+        return None
+
+    def run(self, tasks):
+        """ Process the tasks. The results are returned as soon as they are available
+        :param tasks: iterable of picklable tasks, sent in the same order
+        :return: generator of tuples (task, result, error). error is None if the task has been processed, otherwise it
+        starts with its category: 'error:', 'timeout:' or 'worker died:' and result is the list of values reported with
+        report_result before the failure. Tasks not sent because the workers can not be initialized (e.g. wrong
+        credentials) fail with 'error: worker initialization: ...'
+        """
+        tasks = list(tasks)
+        # Tasks sent to the workers, only the remaining parts after a worker dies (see remaining)
+        sent = list(tasks)
+        pending = collections.deque(range(len(tasks)))
+        requeues = collections.Counter()
+        partials = collections.defaultdict(list)
+        kept = collections.defaultdict(list)
+        finished = set()
+        # Error of the first worker that could not be initialized, new workers would fail in the same way
+        init_error = []
+
+        def notify(event, task_id, value=None):
+            if self.listener:
+                try:
+                    self.listener(event, task_id, value)
+                except Exception:
+                    logging.exception('Listener error')
+
+        def fail(task_id, error):
+            finished.add(task_id)
+            notify('end', task_id, error)
+            return tasks[task_id], kept.pop(task_id, []) + partials.pop(task_id, []), error
+
+        def handle(message):
+            kind, worker_id, task_id, value = message
+            worker = self._workers.get(worker_id)
+            if kind in ('done', 'error'):
+                if worker is not None and worker['task_id'] == task_id:
+                    worker['task_id'] = None
+                if task_id in finished:
+                    return []
+                if kind == 'error':
+                    return [fail(task_id, value)]
+                finished.add(task_id)
+                partials.pop(task_id, None)
+                notify('end', task_id, None)
+                if task_id in kept:
+                    value = kept.pop(task_id) + list(value)
+                return [(tasks[task_id], value, None)]
+            if kind == 'partial' and task_id not in finished:
+                partials[task_id].append(value)
+            elif kind == 'ready' and worker is not None:
+                logging.debug('Worker {} ready'.format(worker_id))
+                worker['ready'] = True
+            elif kind == 'init_error':
+                logging.error('Worker {} not initialized: {}'.format(worker_id, value))
+                init_error.append(value)
+            elif kind == 'recycle' and worker is not None:
+                logging.info('Worker {} recycled: {}'.format(worker_id, value))
+                worker['retiring'] = True
+            elif kind == 'stage' and worker is not None and worker['task_id'] == task_id:
+                worker['stage'] = value
+                worker['stage_started'] = time.time()
+                notify('stage', task_id, value)
+            elif kind == 'hold' and worker is not None:
+                name, held = value
+                if held:
+                    worker['held'].append(name)
+                elif name in worker['held']:
+                    worker['held'].remove(name)
+            return []
+
+        def drain():
+            results = []
+            messages = self._receive(0)
+            while messages:
+                for message in messages:
+                    results.extend(handle(message))
+                messages = self._receive(0)
+            return results
+
+        try:
+            while len(finished) < len(tasks):
+                # <editor-fold desc="Workers can not be initialized: the pending tasks fail, the running ones go on">
+                if init_error:
+                    while pending:
+                        yield fail(pending.popleft(), 'error: worker initialization: {}'.format(init_error[0]))
+                    if len(finished) == len(tasks):
+                        break
+                # </editor-fold>
+
+                # <editor-fold desc="Start workers and send tasks to idle workers">
+                active = [w for w in self._workers.values() if not w['retiring']]
+                for _ in range(0 if init_error else min(self.processes, len(tasks) - len(finished)) - len(active)):
+                    self._start_worker()
+                for worker_id, worker in self._workers.items():
+                    if pending and worker['ready'] and worker['task_id'] is None and not worker['retiring']:
+                        task_id = pending.popleft()
+                        worker['task_id'] = task_id
+                        worker['started'] = time.time()
+                        worker['stage'] = None
+                        worker['stage_started'] = worker['started']
+                        # The listener is called before the task is sent, e.g. to make room for its files
+                        notify('start', task_id, len(sent[task_id]) if hasattr(sent[task_id], '__len__') else 1)
+                        worker['queue'].put((task_id, sent[task_id]))
+                # </editor-fold>
+
+                for message in self._receive(1):
+                    for result in handle(message):
+                        yield result
+
+                # <editor-fold desc="Workers over the time budget are killed, their task is not sent again">
+                now = time.time()
+                timed_out = [(k, self._timed_out(w, now)) for k, w in self._workers.items()
+                             if w['task_id'] is not None and w['task_id'] not in finished]
+                timed_out = [(k, reason) for k, reason in timed_out if reason]
+                if timed_out:
+                    # Parts of the tasks finished before the timeout are kept
+                    for result in drain():
+                        yield result
+                for worker_id, reason in timed_out:
+                    task_id = self._workers[worker_id]['task_id']
+                    if task_id is None or task_id in finished:
+                        continue
+                    logging.warning('Worker {} timeout: {}'.format(worker_id, reason))
+                    # The worker is blocked in the task, it can not be stopped cooperatively
+                    self._stop_worker(worker_id, kill=True)
+                    yield fail(task_id, 'timeout: {}'.format(reason))
+                # </editor-fold>
+
+                # <editor-fold desc="Workers died with a task: the task is sent again">
+                dead = [k for k, w in self._workers.items() if not w['process'].is_alive()]
+                if dead:
+                    # Messages sent by the workers before dying are processed first
+                    for result in drain():
+                        yield result
+                for worker_id in dead:
+                    if worker_id not in self._workers:
+                        continue
+                    task_id = self._workers[worker_id]['task_id']
+                    exitcode = self._workers[worker_id]['process'].exitcode
+                    ready = self._workers[worker_id]['ready']
+                    self._stop_worker(worker_id)
+                    # A worker dying before it is ready has no task, it is an initialization error
+                    if not ready and not init_error:
+                        logging.error('Worker {} died before it was ready (exit code {})'.format(worker_id, exitcode))
+                        init_error.append('worker died before it was ready: exit code {}'.format(exitcode))
+                    if task_id is None or task_id in finished:
+                        continue
+                    if requeues[task_id] < self.max_requeues:
+                        requeues[task_id] += 1
+                        logging.warning('Worker {} died (exit code {}), task requeued'.format(worker_id, exitcode))
+                        values = partials.pop(task_id, [])
+                        if self.remaining is None or not values:
+                            # The whole task is processed again, its parts are reported again
+                            pending.appendleft(task_id)
+                            continue
+                        # The parts already processed are kept and only the rest is sent again
+                        kept[task_id].extend(values)
+                        sent[task_id] = self.remaining(sent[task_id], values)
+                        if sent[task_id]:
+                            pending.appendleft(task_id)
+                        else:
+                            finished.add(task_id)
+                            notify('end', task_id, None)
+                            yield tasks[task_id], kept.pop(task_id), None
+                    else:
+                        yield fail(task_id, 'worker died: exit code {}'.format(exitcode))
+                # </editor-fold>
+        finally:
+            self.close()
+
+    def close(self):
+        """ Stop all the workers. They are asked to exit after their current task and killed only if they do not exit
+        in stop_timeout seconds
+        :return: None
+        """
+        for worker_id in list(self._workers):
+            self._workers[worker_id]['queue'].put(None)
+        for worker_id in list(self._workers):
+            self._stop_worker(worker_id)
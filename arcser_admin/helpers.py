@@ -1,3 +1,5 @@
+import hashlib
+
 
 class ServerException(Exception):
     """  Exception to catch errors during server administration """
@@ -11,4 +13,35 @@ def slicer(list_, n):
         yield list_[i:i + n]
 
 
+def target_server(target):
+    """ Server of a target of ServiceTransporter.targets
+    :param target: url of a federated server or server connection file, or dictionary with the server and the
+    target_data of that server
+    :return: url or path of the server
+    """
+    return target['server'] if isinstance(target, dict) else target
+
+
+def transferred_to(service, target=None):
+    """ Check if a service has been uploaded to a target
+    :param service: ServiceTransporter instance
+    :param target: target of ServiceTransporter.targets, None for the service without targets
+    :return: True if the service has been uploaded
+    """
+    if target is None:
+        return service.transferred
+    return bool(service.target_results.get(target_server(target), {}).get('transferred'))
+
 
+def file_checksum(file_path, algorithm='sha256', chunk_size=1024 * 1024):
+    """ Checksum of a file. The file is read by chunks so big files (sd, tile bundles) are never loaded in memory
+    :param file_path: path to the file
+    :param algorithm: hashlib algorithm name
+    :param chunk_size: bytes read on each iteration
+    :return: hexadecimal digest
+    """
+    h = hashlib.new(algorithm)
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
@@ -0,0 +1,180 @@
+import logging
+import re
+import pandas as pd
+
+
+# Columns of the services table: column name, key in the lowercase properties and type. Only the types of the pandas
+# shipped with ArcGIS Pro 2.2 are used: numbers with missing values are float64 and missing booleans are False
+SERVICE_COLUMNS = [('min_instances', 'mininstancespernode', 'float64'),
+                   ('max_instances', 'maxinstancespernode', 'float64'),
+                   ('instances_per_container', 'instancespercontainer', 'float64'),
+                   ('max_wait_time', 'maxwaittime', 'float64'),
+                   ('max_startup_time', 'maxstartuptime', 'float64'),
+                   ('max_idle_time', 'maxidletime', 'float64'),
+                   ('max_usage_time', 'maxusagetime', 'float64'),
+                   ('recycle_interval', 'recycleinterval', 'float64'),
+                   ('isolation_level', 'isolationlevel', 'category'),
+                   ('provider', 'provider', 'category'),
+                   ('cluster_name', 'clustername', 'category'),
+                   ('capabilities', 'capabilities', 'object'),
+                   ('private', 'private', 'bool')]
+
+
+def _to_bool(value):
+    if value is None:
+        return False
+    if isinstance(value, str):
+        return value.strip().lower() == 'true'
+    return bool(value)
+
+
+def _typed(df, types):
+    for column, dtype in types.items():
+        if dtype == 'float64':
+            df[column] = pd.to_numeric(df[column], errors='coerce').astype('float64')
+        elif dtype == 'bool':
+            df[column] = df[column].map(_to_bool).astype(bool)
+        else:
+            df[column] = df[column].astype(dtype)
+    return df
+
+
+def services_table(service_transporters, server=None):
+    """ Table with one row for each service and the properties flattened in typed columns
+    :param service_transporters: list of ServiceTransporter as returned by create_service_transporter
+    :param server: name of the server of the services, added in the column server
+    :return: pandas.DataFrame
+    """
+    rows = []
+    for s in service_transporters:
+        row = {'server': server, 'qualified_name': s.qualified_name, 'folder': s.folder, 'name': s.name,
+               'type': s.type, 'transferred': s.transferred,
+               'extensions': len(s.properties.get('extensions') or [])}
+        row.update({column: s.properties.get(key) for column, key, _ in SERVICE_COLUMNS})
+        rows.append(row)
+    columns = ['server', 'qualified_name', 'folder', 'name', 'type', 'transferred', 'extensions'] + \
+        [x[0] for x in SERVICE_COLUMNS]
+    df = pd.DataFrame(rows, columns=columns)
+    types = {'server': 'category', 'folder': 'category', 'type': 'category', 'transferred': 'bool',
+             'extensions': 'float64', 'qualified_name': 'object', 'name': 'object'}
+    types.update({column: dtype for column, _, dtype in SERVICE_COLUMNS})
+    return _typed(df, types)
+
+
+def extensions_table(service_transporters, server=None):
+    """ Table with one row for each extension of each service
+    :param service_transporters: list of ServiceTransporter as returned by create_service_transporter
+    :param server: name of the server of the services, added in the column server
+    :return: pandas.DataFrame
+    """
+    rows = []
+    for s in service_transporters:
+        for extension in s.properties.get('extensions') or []:
+            rows.append({'server': server, 'qualified_name': s.qualified_name, 'type': s.type,
+                         'extension': extension.get('typename'), 'enabled': extension.get('enabled'),
+                         'capabilities': extension.get('capabilities')})
+    df = pd.DataFrame(rows, columns=['server', 'qualified_name', 'type', 'extension', 'enabled', 'capabilities'])
+    return _typed(df, {'server': 'category', 'qualified_name': 'object', 'type': 'category', 'extension': 'category',
+                       'enabled': 'bool', 'capabilities': 'object'})
+
+
+def inventory(services_by_server):
+    """ Services and extensions tables of several servers
+    :param services_by_server: dictionary server name: list of ServiceTransporter
+    :return: tuple with the services and extensions tables
+    """
+    services = [services_table(v, k) for k, v in services_by_server.items()]
+    extensions = [extensions_table(v, k) for k, v in services_by_server.items()]
+    # Categories are united so the concatenated columns keep the category type
+    services = pd.concat(services, ignore_index=True) if services else services_table([])
+    extensions = pd.concat(extensions, ignore_index=True) if extensions else extensions_table([])
+    for df in (services, extensions):
+        for column in ('server', 'type', 'folder', 'extension', 'isolation_level', 'provider', 'cluster_name'):
+            if column in df.columns:
+                df[column] = df[column].astype('category')
+    return services, extensions
+
+
+def has_capability(capabilities, capability):
+    """ Vectorized check of a capability in a column of comma separated capabilities, e.g. Query,Create,Update
+    :param capabilities: pandas.Series with the capabilities
+    :param capability: name of the capability, case is ignored
+    :return: boolean pandas.Series
+    """
+    pattern = r'(?:^|,)\s*{}\s*(?:,|$)'.format(re.escape(capability))
+    return capabilities.str.contains(pattern, case=False, regex=True).fillna(False).astype(bool)
+
+
+def services_with_extension(services, extensions, extension, capability=None, enabled=True):
+    """ Services with an extension, e.g. FeatureServer with Update capability
+    :param services: services table
+    :param extensions: extensions table
+    :param extension: type name of the extension e.g. FeatureServer
+    :param capability: capability the extension must have, None for any
+    :param enabled: only the enabled extensions
+    :return: rows of the services table
+    """
+    mask = extensions['extension'] == extension
+    if enabled:
+        mask &= extensions['enabled'].fillna(False).astype(bool)
+    if capability:
+        mask &= has_capability(extensions['capabilities'], capability)
+
+    def keys(df):
+        return pd.MultiIndex.from_arrays([df['server'].astype(object).fillna(''), df['qualified_name'].astype(object)])
+
+    return services[keys(services).isin(list(keys(extensions[mask])))]
+
+
+def services_over(services, column, value):
+    """ Services with a numeric column greater than a value, e.g. services_over(df, 'max_instances', 10)
+    :param services: services table
+    :param column: name of the column
+    :param value: limit
+    :return: rows of the services table
+    """
+    return services[(services[column] > value).fillna(False).astype(bool)]
+
+
+def summarize(services, *by):
+    """ Number of services and total instances grouped by columns, e.g. summarize(df, 'server', 'type')
+    :param services: services table
+    :param by: columns to group by
+    :return: pandas.DataFrame with the columns services, min_instances and max_instances
+    """
+    # Category columns are grouped as objects, otherwise the categories without services are included
+    grouped = services.astype({column: object for column in by}).groupby(list(by))
+    summary = grouped.agg({'qualified_name': 'count', 'min_instances': 'sum', 'max_instances': 'sum'})
+    summary = summary.rename(columns={'qualified_name': 'services'})
+    return summary[['services', 'min_instances', 'max_instances']].reset_index()
+
+
+def save_inventory(services, extensions, path, file_format='parquet'):
+    """ Save the tables in two files, path_services and path_extensions. Parquet needs pyarrow or fastparquet
+    :param services: services table
+    :param extensions: extensions table
+    :param path: path of the files without extension
+    :param file_format: parquet or csv. Parquet needs pandas 0.21 or later and pyarrow or fastparquet, csv is used
+    when they are not installed (e.g. ArcGIS Pro 2.2)
+    :return: list of files created
+    """
+    if file_format == 'parquet' and not hasattr(pd.DataFrame, 'to_parquet'):
+        logging.warning('pandas {} can not write parquet files, inventory saved as csv'.format(pd.__version__))
+        file_format = 'csv'
+    tables = (('services', services), ('extensions', extensions))
+    if file_format == 'parquet':
+        try:
+            return [_save_table(df, path, name, file_format) for name, df in tables]
+        except (ImportError, ValueError) as e:
+            logging.warning('Parquet files not written, inventory saved as csv: {}'.format(str(e)))
+            file_format = 'csv'
+    return [_save_table(df, path, name, file_format) for name, df in tables]
+
+
+def _save_table(df, path, name, file_format):
+    file_path = '{}_{}.{}'.format(path, name, file_format)
+    if file_format == 'parquet':
+        df.to_parquet(file_path, index=False)
+    else:
+        df.to_csv(file_path, encoding='utf-8', sep='|', index=False)
+    return file_path
@@ -0,0 +1,243 @@
+import copy
+import hashlib
+import json
+import logging
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+
+def target_connection_info(source_info, target_connection):
+    """ Connection info of a layer in the target environment. It is the connection info of the target connection with
+    the database and version of the layer in the source environment. This is the rule used by
+    services.change_connection
+    :param source_info: connection_info of the layer (arcpy connectionProperties['connection_info'])
+    :param target_connection: target data source connection, dictionary with the key connection_info
+    :return: dictionary with the new connection info
+    """
+    info = copy.deepcopy(target_connection['connection_info'])
+    info['database'] = source_info.get('database')
+    info['version'] = source_info.get('version')
+    return info
+
+
+# Keys of arcpy connectionProperties['connection_info'] and their names in the workspace connection string of a CIM
+# document. The password of arcpy is not a CIM key, the CIM documents only keep the encrypted password
+CIM_CONNECTION_KEYS = OrderedDict([('server', 'SERVER'), ('instance', 'INSTANCE'), ('dbclient', 'DBCLIENT'),
+                                   ('db_connection_properties', 'DB_CONNECTION_PROPERTIES'), ('database', 'DATABASE'),
+                                   ('user', 'USER'), ('encrypted_password', 'ENCRYPTED_PASSWORD'),
+                                   ('authentication_mode', 'AUTHENTICATION_MODE'), ('version', 'VERSION'),
+                                   ('branch', 'BRANCH'), ('historical_name', 'HISTORICAL_NAME'),
+                                   ('historical_timestamp', 'HISTORICAL_TIMESTAMP')])
+
+# Keys of the database user, not used with operating system authentication
+CIM_CREDENTIAL_KEYS = ('USER', 'ENCRYPTED_PASSWORD')
+
+
+def _connection_parts(connection_string):
+    """ Key and value of each part of a connection string, in the same order and with the keys as they are """
+    parts = []
+    for part in connection_string.split(';'):
+        if '=' in part:
+            key, value = part.split('=', 1)
+            parts.append((key.strip(), value))
+    return parts
+
+
+def parse_connection_string(connection_string):
+    """ Connection info of a workspace connection string of a CIM document, e.g.
+    SERVER=host;INSTANCE=sde:postgresql:host;DBCLIENT=postgresql;DATABASE=db;VERSION=sde.DEFAULT
+    :param connection_string: workspaceConnectionString of a dataConnection
+    :return: dictionary with the keys in lower case as in arcpy connectionProperties['connection_info']
+    """
+    return {key.lower(): value for key, value in _connection_parts(connection_string)}
+
+
+def format_connection_string(connection_info, connection_string=''):
+    """ Workspace connection string of a CIM document with the values of a connection info. The keys of the connection
+    info are translated with CIM_CONNECTION_KEYS and replaced in the existing string, the rest of keys of the string
+    are kept. Keys of the connection info without CIM name (e.g. the plain password) are not written and keys with
+    value None are removed. With operating system authentication the user and password are removed
+    :param connection_info: dictionary as in arcpy connectionProperties['connection_info']
+    :param connection_string: current workspaceConnectionString of the dataConnection
+    :return: connection string
+    """
+    values = OrderedDict(_connection_parts(connection_string))
+    cim_keys = {k.upper(): k for k in values}
+    for key, value in connection_info.items():
+        cim_key = CIM_CONNECTION_KEYS.get(key.lower())
+        if cim_key is None:
+            continue
+        current = cim_keys.setdefault(cim_key, cim_key)
+        if value is None:
+            values.pop(current, None)
+        else:
+            values[current] = value
+    if str(connection_info.get('authentication_mode', '')).upper() == 'OSA':
+        for cim_key in CIM_CREDENTIAL_KEYS:
+            values.pop(cim_keys.get(cim_key, cim_key), None)
+    return ';'.join('{}={}'.format(k, v) for k, v in values.items())
+
+
+def cim_connection_supported(target_connection):
+    """ Say us if the target connection can be written in a CIM document. A database user with a plain password can
+    not, the CIM documents only keep the encrypted password
+    :param target_connection: target data source connection, dictionary with the key connection_info
+    :return: True if the connection can be written
+    """
+    info = {k.lower(): v for k, v in target_connection['connection_info'].items()}
+    return str(info.get('authentication_mode', '')).upper() == 'OSA' or 'encrypted_password' in info or \
+        not info.get('password')
+
+
+def data_connections(document):
+    """ Data connections with a workspace of a CIM document. Nested connections (joins, relates, query tables...) are
+    included
+    :param document: CIM document loaded from json
+    :return: generator of the dictionaries with the keys workspaceConnectionString and workspaceFactory
+    """
+    if isinstance(document, dict):
+        if 'workspaceConnectionString' in document:
+            yield document
+        for value in document.values():
+            yield from data_connections(value)
+    elif isinstance(document, list):
+        for value in document:
+            yield from data_connections(value)
+
+
+def load_mapx(path):
+    """ Load a .mapx document
+    :param path: path of the document
+    :return: CIM document
+    """
+    with open(path, 'r', encoding='utf-8-sig') as f:
+        return json.load(f)
+
+
+def mapx_connection_infos(path):
+    """ Connection info of each enterprise database connection of a .mapx document
+    :param path: path of the document
+    :return: list of dictionaries, one by data connection
+    """
+    return [parse_connection_string(x['workspaceConnectionString']) for x in data_connections(load_mapx(path))
+            if x.get('workspaceFactory') == 'SDE']
+
+
+def rewrite_document(document, target_connection):
+    """ Change the enterprise database connections of a CIM document with the rules of services.change_connection
+    :param document: CIM document loaded from json, it is changed in place
+    :param target_connection: target data source connection, dictionary with the key connection_info
+    :return: tuple with the number of connections changed and the list of workspace factories not supported
+    """
+    changed = 0
+    not_supported = []
+    for connection in data_connections(document):
+        if connection.get('workspaceFactory') != 'SDE':
+            not_supported.append(connection.get('workspaceFactory'))
+            continue
+        connection_string = connection['workspaceConnectionString']
+        info = target_connection_info(parse_connection_string(connection_string), target_connection)
+        connection['workspaceConnectionString'] = format_connection_string(info, connection_string)
+        changed += 1
+    return changed, not_supported
+
+
+def rewrite_mapx(source_path, output_path, target_connection):
+    """ Write a copy of a .mapx document with the data connections changed to the target connection
+    :param source_path: path of the document
+    :param output_path: path of the copy
+    :param target_connection: target data source connection, dictionary with the key connection_info
+    :return: dictionary with source, output, changed and error (None if the document has been rewritten)
+    """
+    result = {'source': source_path, 'output': output_path, 'changed': 0, 'error': None}
+    try:
+        document = load_mapx(source_path)
+        result['changed'], not_supported = rewrite_document(document, target_connection)
+        if not_supported:
+            result['error'] = 'ERROR connection: {}'.format(', '.join(sorted(set(str(x) for x in not_supported))))
+            return result
+        os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+        temp_path = output_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(document, f, indent=2)
+        os.replace(temp_path, output_path)
+    except (OSError, ValueError) as e:
+        result['error'] = 'ERROR rewriting document: {}'.format(str(e))
+    return result
+
+
+def _rewrite_mapx_args(args):
+    return rewrite_mapx(*args)
+
+
+def rewrite_mapx_files(jobs, processes=None, chunksize=16):
+    """ Rewrite documents in parallel in several processes
+    :param jobs: list of tuples (source_path, output_path, target_connection)
+    :param processes: number of processes, None for the number of cores
+    :param chunksize: documents sent together to a process
+    :return: list of results of rewrite_mapx in the same order
+    """
+    if len(jobs) < 2 or processes == 1:
+        return [rewrite_mapx(*x) for x in jobs]
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        return list(executor.map(_rewrite_mapx_args, jobs, chunksize=chunksize))
+
+
+def rewrite_mapx_tree(source_root, output_root, target_connection, processes=None):
+    """ Rewrite all the .mapx documents of a directory tree. The copies keep the relative paths of the documents
+    :param source_root: directory with the documents
+    :param output_root: directory for the copies
+    :param target_connection: target data source connection, dictionary with the key connection_info
+    :param processes: number of processes, None for the number of cores
+    :return: list of results of rewrite_mapx
+    """
+    jobs = []
+    for root, _, files in os.walk(source_root):
+        for file_name in files:
+            if file_name.lower().endswith('.mapx'):
+                source_path = os.path.join(root, file_name)
+                output_path = os.path.join(output_root, os.path.relpath(source_path, source_root))
+                jobs.append((source_path, output_path, target_connection))
+    return rewrite_mapx_files(jobs, processes)
+
+
+def rewrite_service_documents(services, output_root, processes=None):
+    """ Rewrite the .mapx documents of the map services so the data connections are already changed when they are
+    imported. Each document is rewritten once for each target connection. The services get the path of the copy and
+    connection_rewritten True (the original path is kept in original_map_doc_path for targets with other
+    connections), the services of the documents not rewritten are marked as not transferred. Target
+    connections that can not be written in a CIM document (see cim_connection_supported) are left to
+    services.change_connection
+    :param services: list of STMapService with map_doc_path and target_data
+    :param output_root: directory for the copies
+    :param processes: number of processes, None for the number of cores
+    :return: list of results of rewrite_mapx
+    """
+    candidates = [x for x in services if x.transferred and x.target_data and x.map_doc_path and
+                  x.map_doc_path.lower().endswith('.mapx')]
+    not_supported = [x for x in candidates if not cim_connection_supported(x.target_data)]
+    if not_supported:
+        logging.info('{} documents not rewritten, the target connection has a plain password'.format(
+            len(not_supported)))
+        candidates = [x for x in candidates if cim_connection_supported(x.target_data)]
+    keys = {x.qualified_name: (os.path.abspath(x.map_doc_path),
+                               json.dumps(x.target_data, sort_keys=True, default=str)) for x in candidates}
+    jobs = OrderedDict()
+    for service in candidates:
+        key = keys[service.qualified_name]
+        if key not in jobs:
+            digest = hashlib.sha1('|'.join(key).encode('utf-8')).hexdigest()[:12]
+            name = '{}_{}.mapx'.format(os.path.splitext(os.path.basename(service.map_doc_path))[0], digest)
+            jobs[key] = (service.map_doc_path, os.path.join(output_root, name), service.target_data)
+    results = dict(zip(jobs, rewrite_mapx_files(list(jobs.values()), processes)))
+    for service in candidates:
+        result = results[keys[service.qualified_name]]
+        if result['error']:
+            service.transferred = False
+            service.transferred_comment = result['error']
+        else:
+            service.original_map_doc_path = service.map_doc_path
+            service.map_doc_path = result['output']
+            service.connection_rewritten = True
+    return list(results.values())
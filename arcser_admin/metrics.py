@@ -0,0 +1,278 @@
+import collections
+import logging
+import os
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+def failure_category(comment):
+    """ Category of the failure of a service from its ServiceTransporter.transferred_comment
+    :param comment: comment of the service
+    :return: timeout, worker, unsupported, document, import, capacity, connection, sddraft, stage, upload,
+    verification, cache or other
+    """
+    comment = str(comment).lower()
+    # Errors of the worker pool start with their category, exceptions of the handler keep their message
+    if comment.startswith('timeout:'):
+        return 'timeout'
+    if comment.startswith('worker died:'):
+        return 'worker'
+    if comment.startswith('error:'):
+        category = failure_category(comment[len('error:'):])
+        return 'worker' if category == 'other' else category
+    # The stage prefixes are checked before the generic connection pattern, e.g. "Upload service error: connection
+    # reset" is an upload failure
+    categories = [('unsupported', ('servicetransporter creation',)),
+                  ('document', ('map documents', 'no source files', 'rewriting document')),
+                  ('import', ('importing document',)),
+                  ('capacity', ('capacity planning',)),
+                  ('sddraft', ('sddraft',)), ('stage', ('stage service',)),
+                  ('upload', ('upload', 'publish service definition')), ('verification', ('verification',)),
+                  ('cache', ('cache transfer',)), ('connection', ('connection',))]
+    for category, patterns in categories:
+        if any(p in comment for p in patterns):
+            return category
+    return 'other'
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    """ Http server answering each request in a thread (http.server.ThreadingHTTPServer needs Python 3.7) """
+    daemon_threads = True
+
+
+class MigrationMetrics:
+    """ Counters of a migration run: services finished per minute, services in each stage, failures by category and
+    bytes uploaded. The time remaining is estimated from the throughput of the slowest stage in the last minutes """
+
+    def __init__(self, total=0, window=600):
+        """
+        :param total: number of services of the run
+        :param window: seconds used to calculate the throughput
+        """
+        self.total = total
+        self.window = window
+        self.started = time.time()
+        self.completed = 0
+        self.failed = 0
+        self.bytes_uploaded = 0
+        self.failures = collections.Counter()
+        self.in_flight = collections.Counter()
+        self.stage_seconds = collections.Counter()
+        self.stage_count = collections.Counter()
+        self._finished_times = collections.deque()
+        self._stage_times = collections.defaultdict(collections.deque)
+        self._tasks = {}
+        self._lock = threading.Lock()
+
+    def _close_stage(self, key, now):
+        stage, started, size = self._tasks[key]
+        self.in_flight[stage] -= size
+        # The stages are reported for each service of the task, so each stage event is one completion
+        if stage != 'queued':
+            self.stage_seconds[stage] += now - started
+            self.stage_count[stage] += 1
+            self._stage_times[stage].append(now)
+
+    def task_started(self, key, size=1):
+        """ A task (group of services) has been sent to a worker
+        :param key: identifier of the task
+        :param size: number of services of the task
+        :return: None
+        """
+        with self._lock:
+            now = time.time()
+            # A task sent again after its worker died starts from the beginning
+            if key in self._tasks:
+                self._close_stage(key, now)
+            self._tasks[key] = ('queued', now, size)
+            self.in_flight['queued'] += size
+
+    def stage_started(self, key, stage):
+        """ A task has started a new stage, the previous one is finished
+        :param key: identifier of the task
+        :param stage: name of the stage
+        :return: None
+        """
+        with self._lock:
+            if key not in self._tasks:
+                return
+            now = time.time()
+            self._close_stage(key, now)
+            size = self._tasks[key][2]
+            self._tasks[key] = (stage, now, size)
+            self.in_flight[stage] += size
+
+    def task_finished(self, key):
+        """ A task has finished, whatever the result
+        :param key: identifier of the task
+        :return: None
+        """
+        with self._lock:
+            if key in self._tasks:
+                self._close_stage(key, time.time())
+                del self._tasks[key]
+
+    def pool_listener(self, event, key, value=None):
+        """ Listener for engine.WorkerPool events
+        :param event: start, stage or end
+        :param key: identifier of the task
+        :param value: size of the task for start events, name of the stage for stage events
+        :return: None
+        """
+        if event == 'start':
+            self.task_started(key, value or 1)
+        elif event == 'stage':
+            self.stage_started(key, value)
+        elif event == 'end':
+            self.task_finished(key)
+
+    def services_finished(self, services):
+        """ Count the result of processed services
+        :param services: list of ServiceTransporter
+        :return: None
+        """
+        with self._lock:
+            now = time.time()
+            for service in services:
+                self.completed += 1
+                self._finished_times.append(now)
+                # Services with targets count the sd uploaded to each target, even if other targets failed
+                if service.target_results:
+                    sd_files = [x['sd_file'] for x in service.target_results.values() if x['transferred']]
+                else:
+                    sd_files = [service.sd_file] if service.transferred else []
+                self.bytes_uploaded += sum(os.path.getsize(x) for x in sd_files if x and os.path.exists(x))
+                if not service.transferred:
+                    self.failed += 1
+                    self.failures[failure_category(service.transferred_comment)] += 1
+
+    def _rate(self, times, now):
+        while times and times[0] < now - self.window:
+            times.popleft()
+        elapsed = min(self.window, now - self.started)
+        return len(times) / elapsed * 60.0 if elapsed > 0 else 0.0
+
+    def throughput(self):
+        """ Services finished per minute in the window
+        :return: services per minute
+        """
+        with self._lock:
+            return self._rate(self._finished_times, time.time())
+
+    def eta(self):
+        """ Seconds to finish the run. Each service goes through all the stages, so the slowest stage sets the pace
+        :return: seconds, None if there is not enough information
+        """
+        with self._lock:
+            now = time.time()
+            remaining = self.total - self.completed
+            if remaining <= 0:
+                return 0.0
+            rates = [self._rate(times, now) for times in self._stage_times.values()]
+            rates = [r for r in rates if r > 0]
+            rate = min(rates) if rates else self._rate(self._finished_times, now)
+            return remaining / rate * 60.0 if rate > 0 else None
+
+    def summary(self):
+        """ One line with the progress of the run
+        :return: string
+        """
+        eta = self.eta()
+        return 'Services {}/{} failed {} - {:.1f} services/min - ETA {}'.format(
+            self.completed, self.total, self.failed, self.throughput(),
+            '{:.0f} min'.format(eta / 60.0) if eta is not None else 'unknown')
+
+    def to_prometheus(self):
+        """ Metrics in Prometheus text format
+        :return: string
+        """
+        eta = self.eta()
+        throughput = self.throughput()
+        with self._lock:
+            lines = ['# HELP arcser_services_total Services of the migration run',
+                     '# TYPE arcser_services_total gauge',
+                     'arcser_services_total {}'.format(self.total),
+                     '# HELP arcser_services_completed Services processed',
+                     '# TYPE arcser_services_completed counter',
+                     'arcser_services_completed {}'.format(self.completed),
+                     '# HELP arcser_services_per_minute Services processed per minute',
+                     '# TYPE arcser_services_per_minute gauge',
+                     'arcser_services_per_minute {:.3f}'.format(throughput),
+                     '# HELP arcser_bytes_uploaded Bytes of service definitions uploaded',
+                     '# TYPE arcser_bytes_uploaded counter',
+                     'arcser_bytes_uploaded {}'.format(self.bytes_uploaded),
+                     '# HELP arcser_eta_seconds Estimated seconds to finish the run',
+                     '# TYPE arcser_eta_seconds gauge',
+                     'arcser_eta_seconds {}'.format('{:.0f}'.format(eta) if eta is not None else 'NaN'),
+                     '# HELP arcser_services_failed Services not transferred by category',
+                     '# TYPE arcser_services_failed counter']
+            lines.extend('arcser_services_failed{{category="{}"}} {}'.format(k, v)
+                         for k, v in sorted(self.failures.items()))
+            lines.extend(['# HELP arcser_in_flight Services in each stage', '# TYPE arcser_in_flight gauge'])
+            lines.extend('arcser_in_flight{{stage="{}"}} {}'.format(k, v) for k, v in sorted(self.in_flight.items()))
+            lines.extend(['# HELP arcser_stage_seconds Seconds spent in each stage',
+                          '# TYPE arcser_stage_seconds counter'])
+            lines.extend('arcser_stage_seconds{{stage="{}"}} {:.3f}'.format(k, v)
+                         for k, v in sorted(self.stage_seconds.items()))
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path):
+        """ Write the metrics for the textfile collector of the Prometheus node exporter. The file is replaced
+        atomically
+        :param path: path of the .prom file
+        :return: None
+        """
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as f:
+            f.write(self.to_prometheus())
+        os.replace(temp_path, path)
+
+    def write_textfile_periodically(self, path, interval=15):
+        """ Write the textfile from a background thread, so the progress is updated during long stages too
+        :param path: path of the .prom file
+        :param interval: seconds between writes
+        :return: threading.Event, set it to stop the thread. The file is written a last time when it stops
+        """
+        stop = threading.Event()
+
+        def write():
+            while True:
+                stopped = stop.wait(interval)
+                try:
+                    self.write_textfile(path)
+                except OSError as e:
+                    logging.warning('Metrics file {} not written: {}'.format(path, str(e)))
+                if stopped:
+                    return
+
+        threading.Thread(target=write, daemon=True).start()
+        return stop
+
+    def serve(self, port, host='127.0.0.1'):
+        """ Publish the metrics in http://host:port/metrics from a background thread
+        :param port: port of the http server, 0 for a free port
+        :param host: interface of the http server
+        :return: the http server, call shutdown() to stop it
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.to_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug(format % args)
+
+        server = _ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
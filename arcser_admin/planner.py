@@ -0,0 +1,114 @@
+import logging
+import numpy as np
+import pandas as pd
+from arcser_admin.inventory import services_table
+
+
+# Approximate resident memory in MB of one ArcSOC process by service type
+MEMORY_PER_INSTANCE_MB = {'MapServer': 150, 'GeocodeServer': 400, 'GPServer': 250}
+DEFAULT_MEMORY_MB = 200
+
+# Providers of the services running in the shared instance pool, they do not have dedicated instances
+SHARED_PROVIDERS = ('DMaps',)
+
+
+def load_table(service_transporters, memory_per_instance=None):
+    """ Projected load of each service in every machine of the site. For the services with a capacity profile (map
+    services prepared for the target) the instances of the profile are used, for the rest the ones of the properties.
+    Services with isolation LOW share a process among instances_per_container instances and services in the shared
+    instance pool do not have dedicated processes
+    :param service_transporters: list of ServiceTransporter
+    :param memory_per_instance: dictionary service type: MB of a process, see MEMORY_PER_INSTANCE_MB
+    :return: services table of inventory with the columns shared, min_processes, max_processes, min_memory_mb and
+    max_memory_mb
+    """
+    memory = dict(MEMORY_PER_INSTANCE_MB)
+    memory.update(memory_per_instance or {})
+    df = services_table(service_transporters)
+    for column, key in (('min_instances', 'minInstancesPerNode'), ('max_instances', 'maxInstancesPerNode')):
+        profile = [getattr(s, 'capacity_profile', {}).get(key) for s in service_transporters]
+        values = pd.Series([o if v is None else v for v, o in zip(profile, df[column])], index=df.index, dtype=object)
+        df[column] = pd.to_numeric(values, errors='coerce').astype('float64')
+    df['shared'] = df['provider'].astype(object).isin(SHARED_PROVIDERS)
+    per_process = df['instances_per_container'].where(df['isolation_level'].astype(object) == 'LOW', 1).fillna(1)
+    per_process = per_process.clip(lower=1).astype('float64')
+    mb = df['type'].astype(object).map(memory).fillna(DEFAULT_MEMORY_MB).astype('float64')
+    for prefix in ('min', 'max'):
+        processes = np.ceil(df['{}_instances'.format(prefix)].fillna(0) / per_process)
+        processes = processes.where(~df['shared'], 0).astype('int64')
+        df['{}_processes'.format(prefix)] = processes
+        df['{}_memory_mb'.format(prefix)] = processes * mb
+    return df
+
+
+def machine_load(table):
+    """ Load of each machine of the site for a table returned by load_table
+    :param table: load table
+    :return: dictionary with services, shared_services, min_processes, max_processes, min_memory_mb and max_memory_mb
+    """
+    return {'services': int(len(table)), 'shared_services': int(table['shared'].sum()),
+            'min_processes': int(table['min_processes'].sum()), 'max_processes': int(table['max_processes'].sum()),
+            'min_memory_mb': float(table['min_memory_mb'].sum()), 'max_memory_mb': float(table['max_memory_mb'].sum())}
+
+
+def capacity_plan(services, target_services, machine_memory_mb, headroom=0.8, memory_per_instance=None):
+    """ Compare the load the services will add to each machine of the target site with the memory available. The
+    current load is calculated from the services already in the target
+    :param services: list of ServiceTransporter to publish
+    :param target_services: list of ServiceTransporter of the target server (create_service_transporter)
+    :param machine_memory_mb: memory of a machine of the target site
+    :param headroom: part of the memory the services can use
+    :param memory_per_instance: dictionary service type: MB of a process, see MEMORY_PER_INSTANCE_MB
+    :return: dictionary with current, projected and total loads, budget_mb, overcommitted and warnings
+    """
+    current = machine_load(load_table(target_services, memory_per_instance))
+    projected = machine_load(load_table(services, memory_per_instance))
+    total = {k: current[k] + projected[k] for k in current}
+    budget = machine_memory_mb * headroom
+    warnings = []
+    if total['min_memory_mb'] > budget:
+        warnings.append('Minimum instances need {:.0f} MB by machine, budget {:.0f} MB'.format(
+            total['min_memory_mb'], budget))
+    if total['max_memory_mb'] > budget:
+        warnings.append('Maximum instances can need {:.0f} MB by machine, budget {:.0f} MB'.format(
+            total['max_memory_mb'], budget))
+    for w in warnings:
+        logging.warning('Capacity plan: {}'.format(w))
+    return {'current': current, 'projected': projected, 'total': total, 'budget_mb': budget,
+            'overcommitted': total['min_memory_mb'] > budget, 'warnings': warnings}
+
+
+def plan_batches(services, target_services, machine_memory_mb, headroom=0.8, batch_memory_mb=None,
+                 measure='min_memory_mb', memory_per_instance=None):
+    """ Split the services in batches that fit in the memory left in the target site. Each batch adds at most
+    batch_memory_mb by machine. Services that do not fit in the memory left are deferred, they should be migrated when
+    the site has more capacity. The services are taken from the smallest load to the biggest one (by name when the
+    load is the same), so as many services as possible are migrated and the result does not depend on the order of
+    the list
+    :param services: list of ServiceTransporter to publish
+    :param target_services: list of ServiceTransporter of the target server
+    :param machine_memory_mb: memory of a machine of the target site
+    :param headroom: part of the memory the services can use
+    :param batch_memory_mb: memory by machine added by each batch, None for a single batch
+    :param measure: column of load_table used, min_memory_mb or max_memory_mb
+    :param memory_per_instance: dictionary service type: MB of a process, see MEMORY_PER_INSTANCE_MB
+    :return: tuple with the list of batches (lists of ServiceTransporter) and the list of deferred services
+    """
+    available = machine_memory_mb * headroom - load_table(target_services, memory_per_instance)[measure].sum()
+    needed = load_table(services, memory_per_instance)[measure].tolist()
+    candidates = sorted(zip(services, needed), key=lambda x: (x[1], x[0].qualified_name))
+    batches, deferred = [], []
+    batch, batch_memory = [], 0.0
+    for service, memory in candidates:
+        if memory > available:
+            deferred.append(service)
+            continue
+        if batch and batch_memory_mb is not None and batch_memory + memory > batch_memory_mb:
+            batches.append(batch)
+            batch, batch_memory = [], 0.0
+        batch.append(service)
+        batch_memory += memory
+        available -= memory
+    if batch:
+        batches.append(batch)
+    return batches, deferred
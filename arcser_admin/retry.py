@@ -0,0 +1,213 @@
+import logging
+import multiprocessing
+import random
+import re
+import threading
+import time
+
+
+# Messages of errors we expect to disappear if the call is done again after some time
+TRANSIENT_PATTERNS = [r'time[d]?\s*out', r'\b50[234]\b', r'service unavailable', r'bad gateway',
+                      r'connection (was )?(reset|refused|aborted|closed)', r'temporar(il)?y', r'server is busy',
+                      r'too many requests', r'\b429\b', r'could not connect', r'failed to connect',
+                      r'remote end closed', r'network']
+
+# Messages of errors that will be the same whatever the number of attempts
+PERMANENT_PATTERNS = [r'already exists', r'does not exist', r'not found', r'permission', r'not authorized',
+                      r'\b40[0134]\b', r'invalid', r'license']
+
+
+def is_transient_error(message):
+    """ Classify an error message. Permanent patterns are checked first, so an error like "service already exists"
+    is not retried even if the message includes a time out
+    :param message: message of the error
+    :return: True if the error is transient and the call can be retried
+    """
+    message = str(message).lower()
+    if any(re.search(p, message) for p in PERMANENT_PATTERNS):
+        return False
+    return any(re.search(p, message) for p in TRANSIENT_PATTERNS)
+
+
+class RetryPolicy:
+    """ Number of attempts and exponential backoff with full jitter between attempts """
+
+    def __init__(self, max_attempts=4, base_delay=5.0, max_delay=120.0, jitter=True):
+        """
+        :param max_attempts: total number of calls, including the first one
+        :param base_delay: seconds to wait after the first failure
+        :param max_delay: maximum seconds to wait between attempts
+        :param jitter: wait a random time between 0 and the backoff to avoid all workers retrying at the same time
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def delay(self, attempt):
+        """ Seconds to wait after a failed attempt
+        :param attempt: number of the failed attempt starting by 1
+        :return: seconds
+        """
+        backoff = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return random.uniform(0, backoff) if self.jitter else backoff
+
+
+class TokenBucket:
+    """ Limit the rate of calls. The bucket is filled with rate tokens per second up to capacity and each call takes
+    one token """
+
+    def __init__(self, rate, capacity):
+        """
+        :param rate: tokens added per second
+        :param capacity: maximum tokens in the bucket (burst of calls allowed)
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _take(self, now):
+        """ Fill the bucket and take a token. It is called with the lock acquired
+        :return: None if the token has been taken, otherwise seconds to wait for the next one
+        """
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return None
+        return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        """ Take a token, waiting if the bucket is empty
+        :return: None
+        """
+        while True:
+            with self._lock:
+                wait = self._take(time.monotonic())
+            if wait is None:
+                return
+            time.sleep(wait)
+
+
+class SharedTokenBucket(TokenBucket):
+    """ TokenBucket shared by several processes, the tokens are kept in shared memory. It must be created in the
+    parent process and passed to the workers when they start (e.g. in the initargs of engine.WorkerPool) """
+
+    def __init__(self, rate, capacity):
+        """
+        :param rate: tokens added per second for all the processes
+        :param capacity: maximum tokens in the bucket (burst of calls allowed)
+        """
+        self.rate = rate
+        self.capacity = capacity
+        # Tokens and time of the last fill. The monotonic clock is the same for all the processes of the machine
+        self._state = multiprocessing.Array('d', [capacity, time.monotonic()], lock=False)
+        self._lock = multiprocessing.Lock()
+
+    def _take(self, now):
+        tokens = min(self.capacity, self._state[0] + (now - self._state[1]) * self.rate)
+        self._state[1] = now
+        if tokens >= 1:
+            self._state[0] = tokens - 1
+            return None
+        self._state[0] = tokens
+        return (1 - tokens) / self.rate
+
+
+def rate_bucket(per_minute, shared=False):
+    """ Token bucket for a number of calls per minute. Bursts of a tenth of the calls are allowed
+    :param per_minute: calls per minute
+    :param shared: create a SharedTokenBucket for several processes
+    :return: TokenBucket or SharedTokenBucket
+    """
+    return (SharedTokenBucket if shared else TokenBucket)(per_minute / 60.0, max(1, per_minute // 10))
+
+
+class UploadLimiter:
+    """ Limit the uploads to the target site: number of uploads running at the same time and uploads started per
+    minute. It is used as context manager around each upload """
+
+    def __init__(self, max_concurrent=2, per_minute=None, semaphore=None, on_change=None, bucket=None):
+        """
+        :param max_concurrent: uploads running at the same time
+        :param per_minute: uploads started per minute by this process, None for no limit
+        :param semaphore: semaphore shared with other processes (multiprocessing.BoundedSemaphore). If it is passed
+        max_concurrent is ignored and the limit is global for all the processes using it
+        :param on_change: function called with True when the semaphore is acquired and False when it is released
+        :param bucket: token bucket shared with other processes (rate_bucket(per_minute, shared=True)). If it is
+        passed per_minute is ignored and the rate is global for all the processes using it
+        """
+        self.semaphore = semaphore if semaphore is not None else threading.BoundedSemaphore(max_concurrent)
+        self.bucket = bucket if bucket is not None else rate_bucket(per_minute) if per_minute else None
+        self.on_change = on_change
+
+    def __enter__(self):
+        if self.bucket:
+            self.bucket.acquire()
+        self.semaphore.acquire()
+        if self.on_change:
+            self.on_change(True)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.semaphore.release()
+        if self.on_change:
+            self.on_change(False)
+        return False
+
+
+default_policy = RetryPolicy()
+upload_limiter = UploadLimiter()
+
+
+def configure_publishing(policy=None, limiter=None):
+    """ Change the retry policy and the upload limiter used by the publishing functions of this process
+    :param policy: RetryPolicy instance
+    :param limiter: UploadLimiter instance
+    :return: None
+    """
+    global default_policy, upload_limiter
+    if policy is not None:
+        default_policy = policy
+    if limiter is not None:
+        upload_limiter = limiter
+
+
+def call_with_retry(func, *args, policy=None, limiter=None, upload=False, message=str, exists_ok=False, **kwargs):
+    """ Call a function retrying it when a transient error is raised. The last exception is raised when the error is
+    permanent or there are no more attempts
+    :param func: function to call
+    :param args: positional arguments of the function
+    :param policy: RetryPolicy, the default one is used if it is not passed
+    :param limiter: UploadLimiter used around each call, None for no limit
+    :param upload: the call is an upload, the upload limiter of the process is used if limiter is not passed
+    :param message: function to get the error message from the exception (e.g. arcpy messages)
+    :param exists_ok: an "already exists" error after a retry is a success. A call that timed out may have been
+    completed by the server (e.g. UploadServiceDefinition), so the next attempt finds the service already created
+    :param kwargs: keyword arguments of the function
+    :return: the value returned by the function, None if the call was completed by a previous attempt
+    """
+    policy = policy if policy is not None else default_policy
+    limiter = upload_limiter if limiter is None and upload else limiter
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            if limiter is not None:
+                with limiter:
+                    return func(*args, **kwargs)
+            return func(*args, **kwargs)
+        except Exception as e:
+            msg = message(e)
+            if exists_ok and attempt > 1 and re.search(r'already exists', str(msg).lower()):
+                logging.warning('{} already done by a previous attempt: {}'.format(
+                    getattr(func, '__name__', func), msg))
+                return None
+            if attempt >= policy.max_attempts or not is_transient_error(msg):
+                raise
+            delay = policy.delay(attempt)
+            logging.warning('{} failed (attempt {}/{}), retrying in {:.1f}s: {}'.format(
+                getattr(func, '__name__', func), attempt, policy.max_attempts, delay, msg))
+            time.sleep(delay)
@@ -0,0 +1,102 @@
+import json
+import logging
+import os
+
+
+def load_timings(timings_file):
+    """ Load the seconds spent by each service in a previous run
+    :param timings_file: path to json file created by save_timings
+    :return: dictionary with qualified name as key and seconds as value
+    """
+    if not timings_file or not os.path.exists(timings_file):
+        return {}
+    with open(timings_file, 'r') as f:
+        return json.load(f)
+
+
+def save_timings(timings_file, timings):
+    """ Save the seconds spent by each service. The timings of previous runs not included are kept
+    :param timings_file: path to json file
+    :param timings: dictionary with qualified name as key and seconds as value
+    :return: None
+    """
+    all_timings = load_timings(timings_file)
+    all_timings.update(timings)
+    with open(timings_file, 'w') as f:
+        json.dump(all_timings, f, indent=1)
+
+
+def mapx_layer_count(mapx_file):
+    """ Number of layers in a mapx document (the mapx is a json document)
+    :param mapx_file: path to mapx file
+    :return: number of layers, 0 if the document can not be read
+    """
+    try:
+        with open(mapx_file, 'r', encoding='utf-8') as f:
+            return len(json.load(f).get('layerDefinitions', []))
+    except (IOError, ValueError) as e:
+        logging.warning('Layers of {} not counted: {}'.format(mapx_file, str(e)))
+        return 0
+
+
+def estimate_cost(service, size_weight=1.0, layer_weight=0.5):
+    """ Estimate the cost of publishing a service from its source documents: size in MB of the map document or the
+    locator files and number of layers of mapx documents
+    :param service: ServiceTransporter instance
+    :param size_weight: cost of each MB of the documents
+    :param layer_weight: cost of each layer
+    :return: cost in arbitrary units
+    """
+    cost = 0.0
+    map_doc_path = getattr(service, 'map_doc_path', None)
+    if map_doc_path and os.path.exists(map_doc_path):
+        cost += os.path.getsize(map_doc_path) / 1048576.0 * size_weight
+        if map_doc_path.endswith('.mapx'):
+            cost += mapx_layer_count(map_doc_path) * layer_weight
+    for loc_file in getattr(service, 'loc_file_path', None) or []:
+        # The locator is made of several files with the same name and different extension (.loc, .loc.xml, .lox...).
+        # The name must match exactly, Roads must not count the files of Roads_Old
+        directory, file_name = os.path.split(loc_file)
+        base = os.path.splitext(file_name)[0].lower()
+        for file in os.listdir(directory or '.'):
+            path = os.path.join(directory, file)
+            if file.lower().startswith(base + '.') and os.path.isfile(path):
+                cost += os.path.getsize(path) / 1048576.0 * size_weight
+    return cost
+
+
+def service_costs(services, timings=None):
+    """ Cost in seconds of each service. The seconds of a previous run are used when they are available. The estimated
+    cost of the rest of services is converted to seconds with the ratio seconds/cost of the services with timings
+    :param services: list of ServiceTransporter
+    :param timings: dictionary with qualified name as key and seconds as value
+    :return: dictionary with qualified name as key and seconds as value
+    """
+    timings = timings or {}
+    estimated = {s.qualified_name: estimate_cost(s) for s in services}
+
+    known = [s.qualified_name for s in services if s.qualified_name in timings and estimated[s.qualified_name] > 0]
+    ratio = sum(timings[x] for x in known) / sum(estimated[x] for x in known) if known else 1.0
+
+    return {k: timings[k] if k in timings else v * ratio for k, v in estimated.items()}
+
+
+def order_by_cost(services, timings=None):
+    """ Order the services from the most expensive to the cheapest one (longest job first), see service_costs
+    :param services: list of ServiceTransporter
+    :param timings: dictionary with qualified name as key and seconds as value
+    :return: list of ServiceTransporter
+    """
+    costs = service_costs(services, timings)
+    return sorted(services, key=lambda x: costs[x.qualified_name], reverse=True)
+
+
+def order_groups_by_cost(groups, timings=None):
+    """ Order groups of services (e.g. the map services sharing a document) from the most expensive to the cheapest
+    one. The cost of a group is the sum of the costs of its services, so a big group is not dispatched last
+    :param groups: list of lists of ServiceTransporter
+    :param timings: dictionary with qualified name as key and seconds as value
+    :return: list of lists of ServiceTransporter
+    """
+    costs = service_costs([x for group in groups for x in group], timings)
+    return sorted(groups, key=lambda group: sum(costs[x.qualified_name] for x in group), reverse=True)
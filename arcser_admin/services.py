@@ -3,8 +3,18 @@ from arcgis._impl.common._mixins import PropertyMap
 import logging
 import os
 import copy
+import json
 import xml.dom.minidom as DOM
+from collections import OrderedDict
 import pandas as pd
+from arcser_admin.helpers import file_checksum, target_server
+from arcser_admin.capacity import capacity_profile, apply_capacity_profile_sddraft, geoprocessing_settings
+from arcser_admin.retry import call_with_retry
+from arcser_admin.mapx import target_connection_info
+
+
+# Function called when a publishing stage starts, see set_stage_listener
+_stage_listener = None
 
 
 class ServiceProcessException(Exception):
@@ -38,6 +48,15 @@ class ServiceTransporter:
         self.description = 'No description defined yet' if not self.properties['description'] else\
             self.properties['description']
         self.type = self.properties['type']
+        self.latency = None
+        self.latency_regressed = False
+        self.verified = None
+        self.verification_comment = None
+        self.cache_transferred = None
+        self.targets = []
+        self.target_results = {}
+        # sddraft and sd files staged for the targets besides sddraft_file and sd_file, see publish_map_targets
+        self.target_files = []
 
     def __str__(self):
         return self.qualified_name
@@ -56,12 +75,22 @@ class ServiceTransporter:
     def qualified_name(self, x):
         pass
 
+    def update(self, other):
+        """ Copy the state of other instance of the same service, e.g. the copy returned by a worker process
+        :param other: ServiceTransporter instance
+        :return: None
+        """
+        self.__dict__.update(other.__dict__)
+
     def service_overview(self):
         """ Basic information with the status of the service we want to publish
         :return: dictionary with basic information
         """
         return {'qualified_name': self.qualified_name, 'type': self.type, 'transferred': self.transferred,
-                'transferred_comment': self.transferred_comment}
+                'transferred_comment': self.transferred_comment, 'verified': self.verified,
+                'verification_comment': self.verification_comment, 'cache_transferred': self.cache_transferred,
+                'latency': self.latency,
+                'latency_regressed': self.latency_regressed, 'target_results': self.target_results}
 
 
 class STMapService(ServiceTransporter):
@@ -78,6 +107,9 @@ class STMapService(ServiceTransporter):
         self.source_data = None
         self.target_data = None
         self.federated_server = None
+        self.connection_rewritten = False
+        self.original_map_doc_path = None
+        self.capacity_profile = capacity_profile(properties)
 
     @property
     def enabled_extensions(self):
@@ -111,6 +143,8 @@ class STGeoprocessingService(ServiceTransporter):
         :param properties: dictionary from service.properties
         """
         super(STGeoprocessingService, self).__init__(qualified_name, properties)
+        # The data used by the tools is copied to the server unless it is registered in the data store
+        self.copy_data_to_server = True
         self.result_files = None
         self.server_connection_file = None
 
@@ -138,11 +172,13 @@ def create_service_transporter(server, *service_types):
                     ser.append(STMapService(qualified_name, new_properties))
                 elif service.type == 'GeocodeServer':
                     ser.append(STGeocodeService(qualified_name, new_properties))
+                elif service.type == 'GPServer':
+                    ser.append(STGeoprocessingService(qualified_name, new_properties))
                 else:
-                    s = ServiceTransporter(qualified_name, None)
+                    s = ServiceTransporter(qualified_name, new_properties)
                     s.transferred = False
                     s.transferred_comment = 'ServiceTransporter creation: The service type is not accepted'
-                    ser.append(ServiceTransporter(qualified_name, None))
+                    ser.append(s)
     return ser
 
 
@@ -180,6 +216,9 @@ def service_document_path(source_services, root, *extensions):
             elif service.type == 'GeocodeServer':
                 # All loc files within the service folder must be loaded
                 service.loc_file_path = files
+            elif service.type == 'GPServer':
+                # Result files (rlt) or toolboxes used to publish the tools of the service
+                service.result_files = files
         except ServiceProcessException as e:
             service.map_doc_path = None
             service.transferred = False
@@ -201,6 +240,33 @@ def process_directory(directory, *file_ext):
     return f
 
 
+def set_stage_listener(listener):
+    """ Set the function called with the name of each publishing stage when it starts: import, connection, sddraft,
+    stage and upload. It is used by the worker processes to report the progress to the supervisor
+    :param listener: function with the stage name as argument, None to remove the listener
+    :return: None
+    """
+    global _stage_listener
+    _stage_listener = listener
+
+
+def notify_stage(name):
+    """ Report the start of a publishing stage to the listener
+    :param name: name of the stage
+    :return: None
+    """
+    if _stage_listener is not None:
+        _stage_listener(name)
+
+
+def arcpy_message(e):
+    """ Message of an exception raised by an arcpy tool. The error messages of the last tool are used when there are
+    :param e: exception
+    :return: message
+    """
+    return arcpy.GetMessages(2) or str(e)
+
+
 def import_map_document(arc_proj, *map_docs):
     """ Import maps document in a project. It is recommended to import only one document at a time
     :param arc_proj: arcpy.mp.ArcGISProject instance
@@ -268,70 +334,113 @@ def set_location_file(loc_file, replace_from, replace_to):
         f.write(fileloc1)
 
 
-def publish_geocode_service(service: STGeocodeService):
-    """  This function stgae the service and in case the process has not errors then upload the service definition to
-    the server. If some exception is raised a new exception is created
-    :param service: STGeocodeServie instance
+def publish_service(service: ServiceTransporter):
+    """  This function stage the service and in case the process has not errors then upload the service definition to
+    the server using the server connection file. If some exception is raised a new exception is created
+    :param service: ServiceTransporter instance with sddraft_file, sd_file and server_connection_file
     :return:
     :raise: ServiceProcessException in case things go wrong
     """
     try:
-        arcpy.server.StageService(service.sddraft_file, service.sd_file)
+        notify_stage('stage')
+        call_with_retry(arcpy.server.StageService, service.sddraft_file, service.sd_file, message=arcpy_message)
     except arcpy.ExecuteError as e:
         logging.debug("Stage Service has raised an exception")
         logging.debug(arcpy.GetMessages(2))
-        raise ServiceProcessException('Stage service exception: {}'.format(arcpy.GetMessages(2)))
+        comment = 'Stage service exception: {}'.format(arcpy.GetMessages(2))
+        # The sd is shared by all the targets, none of them gets the service
+        for target in service.targets or []:
+            service.target_results[target_server(target)] = {'transferred': False, 'sd_file': None, 'comment': comment}
+        raise ServiceProcessException(comment)
     else:
+        notify_stage('upload')
+        if service.targets:
+            upload_to_targets(service, service.sd_file, service.targets)
+            if not set_targets_outcome(service):
+                raise ServiceProcessException(service.transferred_comment)
+            return
         try:
-            arcpy.server.UploadServiceDefinition(service.sd_file, service.server_connection_file)
+            call_with_retry(arcpy.server.UploadServiceDefinition, service.sd_file, service.server_connection_file,
+                            upload=True, message=arcpy_message, exists_ok=True)
         except arcpy.ExecuteError:
             logging.debug("An error occurred")
             logging.debug(arcpy.GetMessages(2))
             raise ServiceProcessException('Upload service error: {}'.format(arcpy.GetMessages(2)))
 
 
-def set_sddraft_groprocessing(service: STGeoprocessingService):
-
-    # Create service definition draft
-    arcpy.CreateGPSDDraft(
-        result=service.result_files,
-        out_sddraft= service.sddraft_file,
-        service_name= service.name,
-        server_type='FROM_CONNECTION_FILE',
-        connection_file_path=service.server_connection_file,
-        copy_data_to_server=True,
-        folder_name=service.folder,
-        summary=service.description,
-        tags=service.tags,
-        executionType="Synchronous", #TODO: review if this value can be gotten for properties
-        resultMapServer=False, # TODO: Check if this value can be gotten from properties
-        showMessages="INFO", # TODO: Check if this value can be gooten from properties
-        maximumRecords=5000, # TODO:  Check if this value can be gotten from properties
-        minInstances=2, # TODO: Check if can be gotten from properties
-        maxInstances=3, # TODO: Check if can be gotten from properties
-        maxUsageTime=100, # TODO: Check if can be gotten from properties
-        maxWaitTime=10,  # TODO: check if can be gotten form properties
-        maxIdleTime=180) # TODO:  check if can be gotten from properties
-
-    # Analyze the service definition draft
-    # TODO: The sample in esri web is wrong, create gps draft return a dictionary with errors warnings etc
-    # analyzeMessages = arcpy.mapping.AnalyzeForSD(sddraft)
-
-    # Stage and upload the service if the sddraft analysis did not
-    # contain errors
-    # if analyzeMessages['errors'] == {}:
-      #  pass
-        # Execute StageService
-        # arcpy.StageService_server(sddraft, sd)
-        # Execute UploadServiceDefinition
-        # Note; alternatively the URL to a federated server can be used, otherwise
-        # 'My Hosted Services' keyword indicates to publish to the default hosting server
-        # arcpy.UploadServiceDefinition_server(sd, "My Hosted Service")
-    # else:
-       # pass
+def upload_to_targets(service: ServiceTransporter, sd_file, targets):
+    """ Upload a service definition to several servers. The uploads are done one after the other because arcpy is not
+    thread safe. The result of each target is kept in ServiceTransporter.target_results, see set_targets_outcome
+    :param service: ServiceTransporter instance
+    :param sd_file: path to the staged service definition
+    :param targets: list of targets of ServiceTransporter.targets
+    :return: True if the service has been uploaded to all the targets
+    """
+    uploaded = True
+    for target in targets:
+        server = target_server(target)
+        try:
+            call_with_retry(arcpy.server.UploadServiceDefinition, sd_file, server, upload=True,
+                            message=arcpy_message, exists_ok=True)
+        except Exception as e:
+            logging.debug('Upload to {} error: {}'.format(server, arcpy_message(e)))
+            service.target_results[server] = {'transferred': False, 'sd_file': sd_file,
+                                              'comment': 'Upload service error: {}'.format(arcpy_message(e))}
+            uploaded = False
+        else:
+            service.target_results[server] = {'transferred': True, 'sd_file': sd_file, 'comment': None}
+    return uploaded
+
 
+def set_targets_outcome(service: ServiceTransporter):
+    """ Set the status of a service published in several targets from the result of each target. If some target
+    fails ServiceTransporter.transferred is changed to False and the failed targets are added to
+    ServiceTransporter.transferred_comment
+    :param service: ServiceTransporter instance
+    :return: True if the service has been published in all the targets
+    """
+    failed = [(t, x) for t, x in service.target_results.items() if not x['transferred']]
+    if failed:
+        service.transferred = False
+        service.transferred_comment = 'Errors in targets: {}'.format(
+            ' - '.join('{} {}'.format(t, x['comment']) for t, x in failed))
+    return not failed
 
 
+def publish_geocode_service(service: STGeocodeService):
+    """  Stage and upload a geocode service. See publish_service
+    :param service: STGeocodeServie instance
+    :return:
+    :raise: ServiceProcessException in case things go wrong
+    """
+    publish_service(service)
+
+
+def set_sddraft_groprocessing(service: STGeoprocessingService, dummy_name=''):
+    """ Create the sddraft for geoprocessing service. The execution type, messages, maximum records, the pool sizes and
+    the timeouts are taken from the source properties. If some error is reported an exception is raised
+    :param service: instance of STGeoprocessingService
+    :param dummy_name: prefix for the original service name
+    :return:
+    :raise: ServiceProcessException exception in case some an error is reported in the sddraf creation
+    """
+    notify_stage('sddraft')
+    result = arcpy.CreateGPSDDraft(result=service.result_files,
+                                   out_sddraft=service.sddraft_file,
+                                   service_name=dummy_name + service.name,
+                                   server_type='FROM_CONNECTION_FILE',
+                                   connection_file_path=service.server_connection_file,
+                                   copy_data_to_server=service.copy_data_to_server,
+                                   folder_name=service.folder,
+                                   summary=service.description,
+                                   tags=service.tags,
+                                   **geoprocessing_settings(service.properties))
+
+    # CreateGPSDDraft return a dictionary with errors, warnings and messages
+    if result['errors']:
+        logging.debug("Error were returned when creating service definition draft")
+        logging.debug(result['errors'])
+        raise ServiceProcessException(result['errors'])
 
 
 def set_sddraft_geocode(service: STGeocodeService, dummy_name):
@@ -359,6 +468,7 @@ def set_sddraft_geocode(service: STGeocodeService, dummy_name):
     # Warning: do not use till the problem with USGGEST value is fixed. Now use default values
     # capabilities = [capa[x] for x in service.properties['capabilities'].split(',') if x in capa]
 
+    notify_stage('sddraft')
     result = arcpy.CreateGeocodeSDDraft(loc_path=service.loc_file_path[0],
                                         out_sddraft=service.sddraft_file,
                                         service_name=dummy_name + service.name,
@@ -474,10 +584,8 @@ def change_connection(arcgis_map, target_connection, source_connection=None):
             if layer.connectionProperties and layer.connectionProperties['workspace_factory'] == 'SDE':
 
                 copy_properties = copy.deepcopy(layer.connectionProperties)
-                copy_target_connection = copy.deepcopy(target_connection)
-                copy_target_connection['connection_info']['database'] = layer.connectionProperties['connection_info']['database']
-                copy_target_connection['connection_info']['version'] = layer.connectionProperties['connection_info']['version']
-                copy_properties['connection_info'] = copy_target_connection['connection_info']
+                copy_properties['connection_info'] = target_connection_info(
+                    layer.connectionProperties['connection_info'], target_connection)
 
                 print(layer.connectionProperties)
                 # TODO: Check if the change has been done. If it has not been changed the service could be created uploading the
@@ -553,22 +661,48 @@ def processing_geocode_service(service: STGeocodeService, dummy_name=''):
             service.transferred_comment = str(e)
 
 
-def processing_mapservice(arcgis_proj, source_service, **kwargs):
-    """ Create services in the target server based on the attributes of the ServiceTransporter.
+def processing_geoprocessing_service(service: STGeoprocessingService, dummy_name=''):
+    """ Process to publish geoprocessing services. In case some exception is raised ServiceTransporter.transferred is
+    changed False and a comment is added to ServiceTransporter.transferred_comment
+    :param service: STGeoprocessingService instance
+    :param dummy_name: Prefix added to the original service name
+    :return:
+    """
+    try:
+        set_sddraft_groprocessing(service, dummy_name)
+    except ServiceProcessException as e:
+        logging.debug('Geoprocessing Service sddraft error {}'.format(str(e)))
+        service.transferred = False
+        service.transferred_comment = str(e)
+    else:
+        try:
+            publish_service(service)
+        except ServiceProcessException as e:
+            logging.debug('Geoprocessing Service publish error {}'.format(str(e)))
+            service.transferred = False
+            service.transferred_comment = str(e)
+
+
+def prepare_map(arcgis_proj, source_service, target_data=None):
+    """ Import the map document of the service in the project and change the data source of the layers.
     If an error is raised during the process the ServiceTransporter.transferred attribute is changed to False and a
     comment is added.
     :param arcgis_proj: arpy.mp.ArcGISProject instance
-    :param list_services: list of ServiceTransporter
-    :param kwargs: service configuration can be changed but so far only the default configuration is supported
-    :return: None
+    :param source_service: STMapService instance
+    :param target_data: target connection of the map, None for the target_data of the service
+    :return: the map imported in the project, None if there are errors
     """
-    service_conf = {'server_type': 'FEDERATED_SERVER', 'service_type': 'MAP_IMAGE', 'dummy_name': ''}
-    service_conf.update(kwargs)
-
+    target_data = source_service.target_data if target_data is None else target_data
+    # Documents rewritten by mapx.rewrite_service_documents have the target_data of the service already, the original
+    # document is imported for other connections
+    rewritten = source_service.connection_rewritten and target_data == source_service.target_data
+    map_doc_path = source_service.original_map_doc_path if source_service.connection_rewritten and not rewritten \
+        else source_service.map_doc_path
     maps_in_project = [x.name for x in arcgis_proj.listMaps('*')]
     # <editor-fold desc="Import document">
     try:
-        arcgis_proj.importDocument(source_service.map_doc_path)
+        notify_stage('import')
+        arcgis_proj.importDocument(map_doc_path)
         arcgis_proj.save()
     except arcpy.ExecuteWarning as e:
         source_service.transferred = False
@@ -585,8 +719,9 @@ def processing_mapservice(arcgis_proj, source_service, **kwargs):
                 my_map = arcgis_proj.listMaps(m.name)[0]
                 break
         try:
-            if source_service.target_data:
-                result = change_connection(my_map, source_service.target_data, source_service.source_data)
+            if target_data and not rewritten:
+                notify_stage('connection')
+                result = change_connection(my_map, target_data, source_service.source_data)
                 if result:
                     msg = ''
                     for r in result:
@@ -599,63 +734,259 @@ def processing_mapservice(arcgis_proj, source_service, **kwargs):
             source_service.transferred_comment = str(e)
         # </editor-fold>
         else:
-            # <editor-fold desc="Stage service">
-            try:
-                sharing_draft = my_map.getWebLayerSharingDraft(service_conf['server_type'],
-                                                               service_conf['service_type'],
-                                                               service_conf['dummy_name'] + source_service.name)
-                # TODO: Check if there are errors message, if errors then we shoule try to fix then or raise an exception
-                # TODO: Check the specific error for upload the data to the server
-
-                sharing_draft.federatedServerUrl = source_service.federated_server
-                sharing_draft.offline = False
-
-                sharing_draft.credits = source_service.credits
-                sharing_draft.description = source_service.description
-                sharing_draft.copyDataToServer = False # source_service.copy_data_to_server
-                if source_service.folder:
-                    sharing_draft.portalFolder = source_service.folder
-                    sharing_draft.serverFolder = source_service.folder
-                sharing_draft.overwriteExistingService = source_service.overwrite_existing_service
-                sharing_draft.tags = source_service.tags
-
-                sddraft_file = source_service.sddraft_file
-                sd_file = source_service.sd_file
-
-                sharing_draft.exportToSDDraft(sddraft_file)
-                sddraft_file, unmatch = custom_sddraft_mapservice(sddraft_file, source_service.properties)
-
-            except arcpy.ExecuteWarning as e:
-                source_service.transferred = False
-                source_service.transferred_comment = 'Warning in sddraft creation msg:' \
-                                                     ' {}'.format(arcpy.GetMessages(2))
-            except arcpy.ExecuteError as e:
-                source_service.transferred = False
-                source_service.transferred_comment = 'Error in sddraft creation msg:' \
-                                                     ' {}'.format(arcpy.GetMessages(2))
-            # </editor-fold>
-            else:
-                try:
-                    arcpy.StageService_server(sddraft_file, sd_file)
-                except arcpy.ExecuteWarning as e:
-                    source_service.transferred = False
-                    source_service.transferred_comment = 'Warning in stage service msg:' \
-                                                         ' {}'.format(arcpy.GetMessages(2))
-                except arcpy.ExecuteError as e:
-                    source_service.transferred = False
-                    source_service.transferred_comment = 'Error in stage service msg:' \
-                                                         ' {}'.format(arcpy.GetMessages(2))
-                else:
-                    # <editor-fold desc="Uploading to server sections">
-                    try:
-                        arcpy.UploadServiceDefinition_server(sd_file, source_service.federated_server)
-                    except Exception as e:
-                        # TODO: Include a recovery point here
-                        source_service.transferred = False
-                        source_service.transferred_comment = 'Error in publish service definition msg: {}'.format(
-                            str(e))
-                        print(str(e))
-                    # </editor-fold>
+            return my_map
+    return None
+
+
+def stage_map(my_map, source_service, sddraft_file, sd_file, federated_server, **kwargs):
+    """ Create the sddraft of the service from a map already prepared and stage it.
+    If an error is raised during the process the ServiceTransporter.transferred attribute is changed to False and a
+    comment is added.
+    :param my_map: arcpy.mp.Map instance returned by prepare_map
+    :param source_service: STMapService instance
+    :param sddraft_file: path of the sddraft
+    :param sd_file: path of the sd
+    :param federated_server: url of the federated server the sddraft is created for
+    :param kwargs: service configuration can be changed but so far only the default configuration is supported
+    :return: True if the sd has been staged
+    """
+    service_conf = {'server_type': 'FEDERATED_SERVER', 'service_type': 'MAP_IMAGE', 'dummy_name': ''}
+    service_conf.update(kwargs)
+
+    # <editor-fold desc="Stage service">
+    try:
+        notify_stage('sddraft')
+        sharing_draft = my_map.getWebLayerSharingDraft(service_conf['server_type'],
+                                                       service_conf['service_type'],
+                                                       service_conf['dummy_name'] + source_service.name)
+        # TODO: Check if there are errors message, if errors then we shoule try to fix then or raise an exception
+        # TODO: Check the specific error for upload the data to the server
+
+        sharing_draft.federatedServerUrl = federated_server
+        sharing_draft.offline = False
+
+        sharing_draft.credits = source_service.credits
+        sharing_draft.description = source_service.description
+        sharing_draft.copyDataToServer = False # source_service.copy_data_to_server
+        if source_service.folder:
+            sharing_draft.portalFolder = source_service.folder
+            sharing_draft.serverFolder = source_service.folder
+        sharing_draft.overwriteExistingService = source_service.overwrite_existing_service
+        sharing_draft.tags = source_service.tags
+
+        sharing_draft.exportToSDDraft(sddraft_file)
+        sddraft_file, unmatch = custom_sddraft_mapservice(sddraft_file, source_service.properties)
+        if source_service.capacity_profile:
+            apply_capacity_profile_sddraft(sddraft_file, source_service.capacity_profile)
+
+    except arcpy.ExecuteWarning as e:
+        source_service.transferred = False
+        source_service.transferred_comment = 'Warning in sddraft creation msg:' \
+                                             ' {}'.format(arcpy.GetMessages(2))
+    except arcpy.ExecuteError as e:
+        source_service.transferred = False
+        source_service.transferred_comment = 'Error in sddraft creation msg:' \
+                                             ' {}'.format(arcpy.GetMessages(2))
+    # </editor-fold>
+    else:
+        try:
+            notify_stage('stage')
+            call_with_retry(arcpy.StageService_server, sddraft_file, sd_file, message=arcpy_message)
+        except arcpy.ExecuteWarning as e:
+            source_service.transferred = False
+            source_service.transferred_comment = 'Warning in stage service msg:' \
+                                                 ' {}'.format(arcpy.GetMessages(2))
+        except arcpy.ExecuteError as e:
+            source_service.transferred = False
+            source_service.transferred_comment = 'Error in stage service msg:' \
+                                                 ' {}'.format(arcpy.GetMessages(2))
+        else:
+            return True
+    return False
+
+
+def publish_map(my_map, source_service, **kwargs):
+    """ Create the sddraft of the service from a map already prepared, stage it and upload it to the server.
+    If an error is raised during the process the ServiceTransporter.transferred attribute is changed to False and a
+    comment is added. Services with targets are published with publish_map_targets
+    :param my_map: arcpy.mp.Map instance returned by prepare_map
+    :param source_service: STMapService instance
+    :param kwargs: service configuration can be changed but so far only the default configuration is supported
+    :return: None
+    """
+    if stage_map(my_map, source_service, source_service.sddraft_file, source_service.sd_file,
+                 source_service.federated_server, **kwargs):
+        # <editor-fold desc="Uploading to server sections">
+        notify_stage('upload')
+        try:
+            call_with_retry(arcpy.UploadServiceDefinition_server, source_service.sd_file,
+                            source_service.federated_server, upload=True, message=arcpy_message, exists_ok=True)
+        except Exception as e:
+            source_service.transferred = False
+            source_service.transferred_comment = 'Error in publish service definition msg: {}'.format(
+                str(e))
+            print(str(e))
+        # </editor-fold>
+
+
+def target_connection(service: STMapService, target):
+    """ Target connection of the service in a target
+    :param service: STMapService instance
+    :param target: target of ServiceTransporter.targets. A dictionary without target_data uses the one of the service
+    :return: dictionary of the connection
+    """
+    if isinstance(target, dict) and target.get('target_data') is not None:
+        return target['target_data']
+    return service.target_data
+
+
+def staging_keys(service: STMapService):
+    """ Group the targets of a map service by staging configuration: target connection and federated server, both
+    written in the sd. The service is staged once for each key and the sd uploaded only to the targets of the key
+    :param service: STMapService instance with targets (federated server urls)
+    :return: OrderedDict (connection as json, federated server): list of targets
+    """
+    keys = OrderedDict()
+    for target in service.targets:
+        connection = json.dumps(target_connection(service, target), sort_keys=True, default=str)
+        keys.setdefault((connection, target_server(target)), []).append(target)
+    return keys
+
+
+def target_connections(service: STMapService):
+    """ Distinct target connections of the targets of a map service. A map is prepared for each of them
+    :param service: STMapService instance with targets
+    :return: OrderedDict connection as json: dictionary of the connection
+    """
+    connections = OrderedDict()
+    for target in service.targets:
+        connection = target_connection(service, target)
+        connections.setdefault(json.dumps(connection, sort_keys=True, default=str), connection)
+    return connections
+
+
+def staging_files(service: ServiceTransporter, index):
+    """ Paths of the sddraft and sd files of a staging key. The first key uses sddraft_file and sd_file of the service,
+    the rest the same names with the index of the key
+    :param service: ServiceTransporter instance
+    :param index: position of the key in staging_keys
+    :return: tuple with the paths of the sddraft and the sd
+    """
+    if not index:
+        return service.sddraft_file, service.sd_file
+    files = []
+    for path in (service.sddraft_file, service.sd_file):
+        root, extension = os.path.splitext(path)
+        files.append('{}_{}{}'.format(root, index, extension))
+    return tuple(files)
+
+
+def publish_map_targets(maps, source_service, **kwargs):
+    """ Publish a map service in all its targets. The service is staged once for each staging key (see staging_keys),
+    from the map prepared for the connection of the key, and each sd is uploaded to the targets of its key. The result
+    of each target is kept in ServiceTransporter.target_results, see set_targets_outcome
+    :param maps: dictionary connection as json (see target_connections): arcpy.mp.Map instance returned by prepare_map
+    :param source_service: STMapService instance with targets
+    :param kwargs: service configuration, see publish_map
+    :return: True if the service has been published in all the targets
+    """
+    source_service.target_files = []
+    for index, ((connection, server), targets) in enumerate(staging_keys(source_service).items()):
+        sddraft_file, sd_file = staging_files(source_service, index)
+        if index:
+            source_service.target_files.append((sddraft_file, sd_file))
+        if stage_map(maps[connection], source_service, sddraft_file, sd_file, server, **kwargs):
+            notify_stage('upload')
+            upload_to_targets(source_service, sd_file, targets)
+        else:
+            for target in targets:
+                source_service.target_results[target_server(target)] = {
+                    'transferred': False, 'sd_file': None, 'comment': source_service.transferred_comment}
+    return set_targets_outcome(source_service)
+
+
+def processing_mapservice(arcgis_proj, source_service, **kwargs):
+    """ Create services in the target server based on the attributes of the ServiceTransporter.
+    If an error is raised during the process the ServiceTransporter.transferred attribute is changed to False and a
+    comment is added.
+    :param arcgis_proj: arpy.mp.ArcGISProject instance
+    :param source_service: STMapService instance
+    :param kwargs: service configuration can be changed but so far only the default configuration is supported
+    :return: None
+    """
+    processing_mapservice_group(arcgis_proj, [source_service], **kwargs)
+
+
+def map_document_key(service: STMapService):
+    """ Key identifying the maps prepared for a service: content of the map document and target connections. Services
+    with the same key can be published from the same imported maps
+    :param service: STMapService instance
+    :return: tuple with the checksum of the document and the target connection as json (the connections of the
+    targets if the service has targets)
+    """
+    if service.targets:
+        return file_checksum(service.map_doc_path), json.dumps(list(target_connections(service)))
+    return file_checksum(service.map_doc_path), json.dumps(service.target_data, sort_keys=True, default=str)
+
+
+def group_map_services(services):
+    """ Group the map services sharing the same map document content and target connection
+    :param services: list of STMapService
+    :return: list of lists of STMapService
+    """
+    groups = OrderedDict()
+    for service in services:
+        groups.setdefault(map_document_key(service), []).append(service)
+    return list(groups.values())
+
+
+def processing_mapservice_group(arcgis_proj, services, on_service=None, **kwargs):
+    """ Create the services of a group returned by group_map_services. The map document is imported and its data
+    source changed only once, then the sddraft of each service is created from the same map. If the map can not be
+    prepared all the services of the group are marked as not transferred
+    :param arcgis_proj: arpy.mp.ArcGISProject instance
+    :param services: list of STMapService with the same map document and target connection
+    :param on_service: function called with each service once it is processed, None for no call
+    :param kwargs: service configuration, see processing_mapservice
+    :return: None
+    """
+    # Services with targets get a map for each target connection, see publish_map_targets
+    if services[0].targets:
+        maps = OrderedDict((k, prepare_map(arcgis_proj, services[0], v))
+                           for k, v in target_connections(services[0]).items())
+    else:
+        maps = {None: prepare_map(arcgis_proj, services[0])}
+    for service in services:
+        if any(x is None for x in maps.values()):
+            service.transferred = False
+            service.transferred_comment = services[0].transferred_comment
+        elif service.targets:
+            publish_map_targets(maps, service, **kwargs)
+        else:
+            publish_map(maps[None], service, **kwargs)
+        if on_service:
+            on_service(service)
+
+
+def processing_service_group(arcgis_proj, services, dummy_name='', on_service=None):
+    """ Publish a group of services of the same type. Map services are published with processing_mapservice_group, the
+    rest of services one by one
+    :param arcgis_proj: arpy.mp.ArcGISProject instance
+    :param services: list of ServiceTransporter
+    :param dummy_name: Prefix added to the original service name
+    :param on_service: function called with each service once it is processed, None for no call
+    :return: None
+    """
+    for service in services:
+        if service.type == 'MapServer':
+            processing_mapservice_group(arcgis_proj, services, on_service=on_service, dummy_name=dummy_name)
+            break
+        elif service.type == 'GeocodeServer':
+            processing_geocode_service(service, dummy_name=dummy_name)
+        elif service.type == 'GPServer':
+            processing_geoprocessing_service(service, dummy_name=dummy_name)
+        if on_service:
+            on_service(service)
 
 
 def report_to_csv(service_transporters, csv_file):
@@ -671,3 +1002,18 @@ def report_to_csv(service_transporters, csv_file):
     df.to_csv(csv_file, encoding='utf-8', sep='|')
 
 
+def report_targets_to_csv(service_transporters, csv_file):
+    """ Report with one row for each service and target server when the services are uploaded to several targets
+    :param service_transporters: list of ServiceTransporter
+    :param csv_file: path to create the csv file
+    :return: None
+    """
+    v = []
+    for t in service_transporters:
+        for target, result in t.target_results.items():
+            v.append({'qualified_name': t.qualified_name, 'type': t.type, 'target': target,
+                      'transferred': result['transferred'], 'transferred_comment': result['comment'],
+                      'verified': result.get('verified'), 'verification_comment': result.get('verification_comment'),
+                      'latency_regressed': result.get('latency_regressed')})
+    df = pd.DataFrame(v)
+    df.to_csv(csv_file, encoding='utf-8', sep='|')
@@ -0,0 +1,147 @@
+import arcgis
+import arcpy
+import json
+import logging
+import ssl
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+
+class SessionException(Exception):
+    """ Exception to catch errors authenticating in a portal """
+
+    def __init__(self, message):
+        super().__init__(message)
+
+
+class SessionTicket:
+    """ Token of a portal generated by generate_token """
+
+    def __init__(self, url, username, token, expires):
+        """
+        :param url: url of the portal
+        :param username: user of the token
+        :param token: token generated by the portal
+        :param expires: expiration time of the token (seconds since epoch)
+        """
+        self.url = url
+        self.username = username
+        self.token = token
+        self.expires = expires
+
+    def valid(self, margin=0):
+        """ Say us if the token can still be used
+        :param margin: seconds the token must still be valid
+        :return: True if the token expires after margin seconds
+        """
+        return self.expires - margin > time.time()
+
+
+def generate_token(url, username, password, expiration=60, verify_cert=True):
+    """ Generate a token with the generateToken operation of the portal. The token is bound to the IP of this
+    machine, so it can be used in the requests made from here without a Referer header (see verification)
+    :param url: url of the portal e.g. https://host/arcgis
+    :param username: user of the portal
+    :param password: password of the user
+    :param expiration: minutes the token is valid
+    :param verify_cert: verify the ssl certificate of the portal
+    :return: SessionTicket
+    :raise: SessionException in case the token can not be generated
+    """
+    data = urllib.parse.urlencode({'username': username, 'password': password, 'client': 'requestip',
+                                   'expiration': expiration, 'f': 'json'}).encode('utf-8')
+    context = None if verify_cert else ssl._create_unverified_context()
+    try:
+        with urllib.request.urlopen(url.rstrip('/') + '/sharing/rest/generateToken', data, context=context) as r:
+            content = json.loads(r.read().decode('utf-8'))
+    except (OSError, ValueError) as e:
+        raise SessionException('Token not generated for {}: {}'.format(url, str(e)))
+    if 'token' not in content:
+        raise SessionException('Token not generated for {}: {}'.format(url, content.get('error')))
+    return SessionTicket(url, username, content['token'], content['expires'] / 1000.0)
+
+
+class SessionManager:
+    """ Keep one authenticated GIS and one token for each portal and user, so the login is done only once by process.
+    The tokens are refreshed before they expire. arcpy 2.2 only signs in with user and password, so the publishing
+    workers get the credentials and sign in with sign_in_arcpy """
+
+    def __init__(self, expiration=60, refresh_margin=300, verify_cert=True):
+        """
+        :param expiration: minutes the generated tokens are valid
+        :param refresh_margin: seconds before the expiration when a token is refreshed
+        :param verify_cert: verify the ssl certificate of the portals
+        """
+        self.expiration = expiration
+        self.refresh_margin = refresh_margin
+        self.verify_cert = verify_cert
+        self._credentials = {}
+        self._gis = {}
+        self._tickets = {}
+        self._arcpy_sign_in = set()
+        self._lock = threading.Lock()
+
+    def register(self, url, username, password):
+        """ Keep the credentials of a portal to authenticate and refresh the tokens when they are needed
+        :param url: url of the portal
+        :param username: user of the portal
+        :param password: password of the user
+        :return: None
+        """
+        with self._lock:
+            self._credentials[(url, username)] = password
+
+    def gis(self, url, username, password=None):
+        """ Authenticated GIS of a portal. It is created the first time and reused after that
+        :param url: url of the portal
+        :param username: user of the portal
+        :param password: password of the user, not needed if the credentials have been registered
+        :return: arcgis.gis.GIS
+        """
+        key = (url, username)
+        if password is not None:
+            self.register(url, username, password)
+        with self._lock:
+            if key not in self._gis:
+                self._gis[key] = arcgis.gis.GIS(url, username, self._credentials[key],
+                                                verify_cert=self.verify_cert)
+            return self._gis[key]
+
+    def ticket(self, url, username):
+        """ Valid token of a portal for the requests made without arcgis (e.g. verification). The token of the GIS
+        is not reused because arcgis binds it to a referer. A new token is generated when there is not one or it is
+        about to expire
+        :param url: url of the portal
+        :param username: user of the portal, the credentials must have been registered
+        :return: SessionTicket
+        """
+        key = (url, username)
+        with self._lock:
+            ticket = self._tickets.get(key)
+            if ticket is None or not ticket.valid(self.refresh_margin):
+                logging.debug('Generating token for {} in {}'.format(username, url))
+                ticket = generate_token(url, username, self._credentials[key], self.expiration, self.verify_cert)
+                self._tickets[key] = ticket
+            return ticket
+
+    def sign_in_arcpy(self, url, username, password=None):
+        """ Sign in arcpy in a portal. Only the first call of the process signs in
+        :param url: url of the portal
+        :param username: user of the portal
+        :param password: password of the user, not needed if the credentials have been registered
+        :return: None
+        """
+        key = (url, username)
+        if password is not None:
+            self.register(url, username, password)
+        with self._lock:
+            if key not in self._arcpy_sign_in:
+                arcpy.SignInToPortal(url, username, self._credentials[key])
+                self._arcpy_sign_in.add(key)
+
+
+# Session manager of the process
+session_manager = SessionManager()
+
@@ -0,0 +1,195 @@
+import json
+import logging
+import os
+import ssl
+import statistics
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from arcser_admin.helpers import target_server, transferred_to
+
+
+class VerificationException(Exception):
+    """ Exception to catch errors requesting a service """
+
+    def __init__(self, message):
+        super().__init__(message)
+
+
+def service_url(server_url, folder, service_name, service_type):
+    """ REST url of a service
+    :param server_url: url of the server e.g. https://host:6443/arcgis
+    :param folder: folder of the service, None or '/' for root folder
+    :param service_name: name of the service
+    :param service_type: type of the service e.g. MapServer
+    :return: url of the service
+    """
+    parts = [server_url.rstrip('/'), 'rest', 'services']
+    if folder and folder != '/':
+        parts.append(folder)
+    parts.extend([service_name, service_type])
+    return '/'.join(parts)
+
+
+def timed_request(url, params=None, token=None, timeout=60, verify_cert=True):
+    """ Request an url and measure the time until the whole response is read
+    :param url: url to request
+    :param params: dictionary with the query parameters
+    :param token: token added to the request
+    :param timeout: seconds to wait for the response
+    :param verify_cert: verify the ssl certificate of the server
+    :return: tuple with seconds and the response body
+    :raise: VerificationException if the request fails or the service returns an error
+    """
+    params = dict(params or {})
+    if token:
+        params['token'] = token
+    full_url = '{}?{}'.format(url, urllib.parse.urlencode(params)) if params else url
+    context = None if verify_cert else ssl._create_unverified_context()
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(full_url, timeout=timeout, context=context) as response:
+            body = response.read()
+    except (urllib.error.URLError, OSError) as e:
+        raise VerificationException('Request {} failed: {}'.format(url, str(e)))
+    elapsed = time.perf_counter() - start
+    if params.get('f') == 'json':
+        try:
+            content = json.loads(body.decode('utf-8'))
+        except ValueError:
+            raise VerificationException('Request {} did not return json'.format(url))
+        if isinstance(content, dict) and 'error' in content:
+            raise VerificationException('Request {} error: {}'.format(url, content['error']))
+        return elapsed, content
+    return elapsed, body
+
+
+def warmup_requests(url, service_json, service_type, sample_address='1 Main Street'):
+    """ List of requests exercising the service: export and identify for maps, findAddressCandidates for geocoders
+    :param url: url of the service
+    :param service_json: description of the service (f=json)
+    :param service_type: type of the service
+    :param sample_address: address used to request the geocoders
+    :return: list of tuples (url, params)
+    """
+    if service_type == 'MapServer':
+        extent = service_json.get('initialExtent') or service_json.get('fullExtent')
+        if not extent:
+            return []
+        bbox = '{},{},{},{}'.format(extent['xmin'], extent['ymin'], extent['xmax'], extent['ymax'])
+        center = '{},{}'.format((extent['xmin'] + extent['xmax']) / 2.0, (extent['ymin'] + extent['ymax']) / 2.0)
+        sr = extent.get('spatialReference', {}).get('wkid', '')
+        return [(url + '/export', {'bbox': bbox, 'bboxSR': sr, 'size': '400,400', 'format': 'png', 'f': 'json'}),
+                (url + '/identify', {'geometry': center, 'geometryType': 'esriGeometryPoint', 'sr': sr,
+                                     'mapExtent': bbox, 'imageDisplay': '400,400,96', 'tolerance': 3,
+                                     'layers': 'all', 'returnGeometry': 'false', 'f': 'json'})]
+    if service_type == 'GeocodeServer':
+        field = service_json.get('singleLineAddressField', {}).get('name', 'SingleLine')
+        return [(url + '/findAddressCandidates', {field: sample_address, 'maxLocations': 5, 'f': 'json'})]
+    return []
+
+
+def measure_service(url, service_type, warmup=8, concurrency=4, token=None, timeout=60, verify_cert=True):
+    """ Send a set of requests to the service. The first one is the cold request, the rest are sent concurrently
+    :param url: url of the service
+    :param service_type: type of the service
+    :param warmup: number of warm requests
+    :param concurrency: warm requests sent at the same time
+    :param token: token for secured services
+    :param timeout: seconds to wait for each response
+    :param verify_cert: verify the ssl certificate of the server
+    :return: dictionary with cold and warm (median) latency in seconds and the number of errors
+    :raise: VerificationException if the service does not respond
+    """
+    elapsed, service_json = timed_request(url, {'f': 'json'}, token, timeout, verify_cert)
+    operations = warmup_requests(url, service_json, service_type)
+    if not operations:
+        return {'cold': elapsed, 'warm': elapsed, 'errors': 0}
+
+    cold, _ = timed_request(operations[0][0], operations[0][1], token, timeout, verify_cert)
+
+    def request(i):
+        operation_url, params = operations[i % len(operations)]
+        try:
+            return timed_request(operation_url, params, token, timeout, verify_cert)[0]
+        except VerificationException as e:
+            logging.warning(str(e))
+            return None
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        times = list(executor.map(request, range(warmup)))
+
+    ok = [t for t in times if t is not None]
+    return {'cold': cold, 'warm': statistics.median(ok) if ok else None, 'errors': len(times) - len(ok)}
+
+
+def set_verification(service, target=None, **values):
+    """ Keep the result of the verification of a service in the service or, for a target, in
+    ServiceTransporter.target_results
+    :param service: ServiceTransporter instance
+    :param target: target of ServiceTransporter.targets, None for the service without targets
+    :param values: verified, verification_comment, latency and latency_regressed
+    :return: None
+    """
+    if target is None:
+        for key, value in values.items():
+            setattr(service, key, value)
+    else:
+        service.target_results[target_server(target)].update(values)
+
+
+def verify_services(services, target_server_url, source_server_url=None, dummy_name='', warmup=8, concurrency=4,
+                    threshold=1.5, target_token=None, source_token=None, timeout=60, verify_cert=True, target=None):
+    """ Warm up the services published in the target server and compare their latency with the source services. The
+    result is kept in ServiceTransporter.latency and ServiceTransporter.latency_regressed is True when the warm latency
+    of the target is greater than the one of the source multiplied by threshold. The result of the check is kept in
+    ServiceTransporter.verified and ServiceTransporter.verification_comment, the transferred status is not changed
+    because the service is published anyway
+    :param services: list of ServiceTransporter
+    :param target_server_url: url of the target server e.g. https://host:6443/arcgis
+    :param source_server_url: url of the source server, None to not measure the source
+    :param dummy_name: prefix added to the original service name when the service was published
+    :param warmup: number of warm requests for each service
+    :param concurrency: warm requests sent at the same time
+    :param threshold: ratio target/source warm latency considered a regression
+    :param target_token: token for target server
+    :param source_token: token for source server
+    :param timeout: seconds to wait for each response
+    :param verify_cert: verify the ssl certificate of the servers
+    :param target: target of ServiceTransporter.targets with the url target_server_url. Only the services uploaded to
+    it are verified and the result is kept in ServiceTransporter.target_results. None for services without targets
+    :return: list of ServiceTransporter with latency regression
+    """
+    regressed = []
+    for service in [x for x in services if transferred_to(x, target)]:
+        target_url = service_url(target_server_url, service.folder, dummy_name + service.name, service.type)
+        try:
+            measured = measure_service(target_url, service.type, warmup, concurrency, target_token, timeout,
+                                       verify_cert)
+        except VerificationException as e:
+            set_verification(service, target, verified=False,
+                             verification_comment='Verification error: {}'.format(str(e)))
+            continue
+
+        latency = {'target_cold': measured['cold'], 'target_warm': measured['warm'], 'source_warm': None}
+        if source_server_url:
+            source_folder = os.path.split(service.qualified_name)[0]
+            source_url = service_url(source_server_url, source_folder, service.name, service.type)
+            try:
+                source = measure_service(source_url, service.type, warmup, concurrency, source_token, timeout,
+                                         verify_cert)
+                latency['source_warm'] = source['warm']
+            except VerificationException as e:
+                logging.warning('Source latency of {} not measured: {}'.format(service.qualified_name, str(e)))
+
+        source_warm = latency['source_warm']
+        latency_regressed = bool(source_warm and measured['warm'] and measured['warm'] > source_warm * threshold)
+        set_verification(service, target, verified=True, verification_comment=None, latency=latency,
+                         latency_regressed=latency_regressed)
+        if latency_regressed:
+            regressed.append(service)
+            logging.warning('Latency of {} regressed in {}: {:.3f}s source, {:.3f}s target'.format(
+                service.qualified_name, target_server_url, source_warm, measured['warm']))
+    return regressed
@@ -0,0 +1,128 @@
+import arcpy
+import logging
+import os
+import shutil
+import tempfile
+import time
+from arcser_admin.engine import report_stage, report_hold, report_result, request_recycle
+from arcser_admin.retry import configure_publishing, UploadLimiter
+from arcser_admin.services import processing_service_group, set_stage_listener
+from arcser_admin.sessions import session_manager
+
+
+# Default maximum seconds of each publishing stage reported with services.notify_stage
+STAGE_TIMEOUTS = {'import': 1800, 'connection': 1800, 'sddraft': 1800, 'stage': 3600, 'upload': 3600}
+
+
+def init_publishing_worker(arc_proj_template, temps_folder=None, dummy_name='', portal=None, user=None, password=None,
+                           upload_semaphore=None, upload_bucket=None):
+    """ Initializer of the publishing workers of engine.WorkerPool. Each worker imports arcpy, signs in the portal
+    and opens its own copy of the project once, the project is reset after each task. A new worker (e.g. after
+    recycling) starts with a fresh copy
+    :param arc_proj_template: path to the arcgis project used as template
+    :param temps_folder: folder where the copy of the project is created, None for the system temp folder
+    :param dummy_name: prefix added to the original service names
+    :param portal: portal where arcpy signs in, None to not sign in
+    :param user: user of the portal
+    :param password: password of the user
+    :param upload_semaphore: multiprocessing semaphore shared by the workers to limit the uploads
+    :param upload_bucket: retry.SharedTokenBucket shared by the workers to limit the uploads per minute, None for no
+    limit
+    :return: state of the worker
+    """
+    if portal:
+        session_manager.sign_in_arcpy(portal, user, password)
+    if upload_semaphore is not None:
+        # The supervisor releases the semaphore if the worker is killed during an upload
+        configure_publishing(limiter=UploadLimiter(semaphore=upload_semaphore, bucket=upload_bucket,
+                                                   on_change=lambda held: report_hold('upload', held)))
+    # The stages are reported to the supervisor to apply the stage timeouts
+    set_stage_listener(report_stage)
+    temp_folder = tempfile.mkdtemp(dir=temps_folder)
+    pro = os.path.join(temp_folder, 'arcgis_proj.aprx')
+    shutil.copy2(arc_proj_template, pro)
+    project = arcpy.mp.ArcGISProject(pro)
+    return {'project': project, 'temp_folder': temp_folder, 'dummy_name': dummy_name,
+            'boot_maps': [x.name for x in project.listMaps('*')]}
+
+
+def reset_project(state):
+    """ Remove from the project of the worker the maps imported since the worker started, so the project does not
+    grow with each service
+    :param state: state returned by init_publishing_worker
+    :return: None
+    """
+    project = state['project']
+    for m in project.listMaps('*'):
+        if m.name not in state['boot_maps']:
+            project.deleteItem(m)
+    project.save()
+
+
+def publish_group(state, group):
+    """ Handler of the publishing workers. Each service is reported to the supervisor as soon as it is processed, so
+    its result is kept if the group does not finish. The time of a service is the time since the previous one was
+    processed (the first service of a map group includes the import of the map). If the project can not be reset the
+    result of the group is kept and the worker is recycled, so the next group gets a new project
+    :param state: state returned by init_publishing_worker
+    :param group: list of ServiceTransporter of the same type
+    :return: list of tuples (ServiceTransporter, seconds)
+    """
+    results = []
+    last = [time.time()]
+
+    def on_service(service):
+        now = time.time()
+        results.append((service, now - last[0]))
+        last[0] = now
+        report_result(results[-1])
+
+    try:
+        processing_service_group(state['project'], group, state['dummy_name'], on_service=on_service)
+    finally:
+        try:
+            reset_project(state)
+        except Exception as e:
+            logging.exception('Project of the worker not reset')
+            request_recycle('project not reset: {}'.format(str(e)))
+    return results
+
+
+def remaining_group(group, results):
+    """ Services of a group without result when its worker dies, see engine.WorkerPool remaining. The services already
+    processed are not published again
+    :param group: list of ServiceTransporter sent to the worker
+    :param results: list of tuples (ServiceTransporter, seconds) reported by the worker
+    :return: list of ServiceTransporter
+    """
+    processed = {service.qualified_name for service, elapsed in results}
+    return [x for x in group if x.qualified_name not in processed]
+
+
+def close_publishing_worker(state):
+    """ Finalizer of the publishing workers. The copy of the project is removed. The copies of workers killed by the
+    supervisor are removed with the folder of create_workers_folder
+    :param state: state returned by init_publishing_worker
+    :return: None
+    """
+    if state is None:
+        return
+    state.pop('project', None)
+    shutil.rmtree(state['temp_folder'], ignore_errors=True)
+
+
+def create_workers_folder(temps_folder=None):
+    """ Folder for the copies of the project of all the workers of a run. Workers killed by the supervisor do not run
+    their finalizer, so the folder must be removed with remove_workers_folder when the pool is closed
+    :param temps_folder: parent folder, None for the system temp folder
+    :return: path of the folder
+    """
+    return tempfile.mkdtemp(prefix='arcser_workers_', dir=temps_folder)
+
+
+def remove_workers_folder(workers_folder):
+    """ Remove the folder of create_workers_folder and the copies of the project left in it
+    :param workers_folder: path of the folder
+    :return: None
+    """
+    shutil.rmtree(workers_folder, ignore_errors=True)
@@ -1,9 +1,13 @@
-import arcgis
 import arcpy
 import os
-import logging
+from arcser_admin.artifacts import ArtifactStore
+from arcser_admin.sessions import session_manager
+from arcser_admin.capacity import scale_capacity_profile, apply_capacity_profiles_server, target_admin_servers
+from arcser_admin.connections import connection_validator
+from arcser_admin.mapx import rewrite_service_documents
 from arcser_admin.services import create_service_transporter, service_document_path,\
-    processing_mapservice, report_to_csv, processing_geocode_service, ServiceTransporter
+    processing_mapservice_group, group_map_services, report_to_csv, report_targets_to_csv, processing_geocode_service,\
+    processing_geoprocessing_service
 import pandas as pd
 from pandas import DataFrame
 
@@ -12,7 +16,9 @@ from test_global_variables import CONNECTIONS
 
 def main(portal_source, user_source, password_source, portal_target, user_target, password_target, services_folder_path,
          source_connection, target_connection, workspace, arcgis_project, prefix_service_name, default_folder,
-         report_output, root_from, root_to, server_connection_file, list_service_to_copy, delete):
+         report_output, root_from, root_to, server_connection_file, list_service_to_copy, delete,
+         capacity_scale=1.0, max_instances=None,
+         target_servers=None, workspace_quota=None, rewrite_mapx=True):
     """
     :param portal_source: Portal source to copy the data
     :param user_source: User of portal source
@@ -32,6 +38,15 @@ def main(portal_source, user_source, password_source, portal_target, user_target
     :param root_to: Target root loc files
     :param server_connection_file: Path to server connection file
     :param list_service_to_copy: Path to csv file to
+    :param capacity_scale: Factor applied to the instances of the source services in the target environment
+    :param max_instances: Maximum instances per node allowed in the target environment
+    :param target_servers: List of federated server urls or server connection files, or dictionaries with the server
+    and its own target_data ({'server': url, 'target_data': connection}). If it is passed each service is staged once
+    for each distinct connection and federated server and uploaded to the servers using them. The capacity settings
+    and the verification are applied to each federated server
+    :param workspace_quota: Maximum bytes used by sddraft and sd files in the workspace, None for no limit
+    :param rewrite_mapx: Rewrite the data connections of the .mapx documents before publishing instead of changing
+    them layer by layer in the imported maps
     :return:
     """
 
@@ -39,15 +54,10 @@ def main(portal_source, user_source, password_source, portal_target, user_target
                                         names=['service_name'])
     service_for_copy = [x for x in service_df['service_name']]
 
-    # reference to portal we wnat to use
-    result = arcpy.SignInToPortal(portal_url='https://dfs-arcgis-71.dpkodev.un.org/arcgis', username='jbelo01',
-                         password='Abcd1234')
-
-    print(result)
-
-    # <editor-fold desc="Creation of the arcgis.GIS instances">
-    source_gis = arcgis.gis.GIS(portal_source, user_source, password_source)
-    target_gis = arcgis.gis.GIS(portal_target, user_target, password_target)
+    # <editor-fold desc="Creation of the arcgis.GIS instances. arcpy and GIS sign in separately, same credentials">
+    session_manager.sign_in_arcpy(portal_target, user_target, password_target)
+    source_gis = session_manager.gis(portal_source, user_source, password_source)
+    target_gis = session_manager.gis(portal_target, user_target)
     # </editor-fold>
 
     # <editor-fold desc="Getting the servers
@@ -56,7 +66,7 @@ def main(portal_source, user_source, password_source, portal_target, user_target
     # </editor-folder>
 
     # <editor-fold desc="Get the list of ServiceTransporter. Only the Mapservers are loaded">
-    source_service = create_service_transporter(source_server, 'MapServer', 'GeocodeServer')
+    source_service = create_service_transporter(source_server, 'MapServer', 'GeocodeServer', 'GPServer')
     # </editor-fold>
 
     # <editor-fold desc="Check if the service in the source are there">
@@ -77,26 +87,30 @@ def main(portal_source, user_source, password_source, portal_target, user_target
                     # s1.delete()
     # </editor-fold>
 
-    service_document_path([x for x in source_service if x.transferred], services_folder_path, *['.mapx', '.mxd', '.loc'])
+    service_document_path([x for x in source_service if x.transferred], services_folder_path, *['.mapx', '.mxd', '.loc', '.rlt'])
     subset_transfer_services = [x for x in source_service if x.transferred]
 
     for serv in subset_transfer_services:
+        if target_servers:
+            serv.targets = list(target_servers)
         if serv.type == 'GeocodeServer':
             serv.server_connection_file = server_connection_file
             serv.from_root = root_from
             serv.to_root = root_to
+        if serv.type == 'GPServer':
+            serv.server_connection_file = server_connection_file
         if serv.type == 'MapServer':
             serv.source_data = source_connection
             serv.target_data = target_connection
+            serv.capacity_profile = scale_capacity_profile(serv.capacity_profile, capacity_scale, max_instances)
             serv.federated_server = 'https://dfs-arcgis-71.dpkodev.un.org:6443/arcgis'
 
     root = workspace
 
     # <editor-fold desc="Creation of directories">
+    store = ArtifactStore(root, workspace_quota)
     for serv in subset_transfer_services:
-        serv.sddraft_file = os.path.join(root, serv.qualified_name, serv.name + '.sddraft')
-        serv.sd_file = os.path.join(root, serv.qualified_name, serv.name + '.sd')
-        os.makedirs(os.path.join(root, serv.qualified_name), exist_ok=True)
+        store.prepare(serv)
     # </editor-fold>
 
     if default_folder:
@@ -105,17 +119,53 @@ def main(portal_source, user_source, password_source, portal_target, user_target
 
     arcgis_proj = arcpy.mp.ArcGISProject(arcgis_project)
 
+    # <editor-fold desc="Each distinct target connection is tested once, services with unusable ones are not published">
+    connection_validator.validate(subset_transfer_services)
+    # </editor-fold>
+
+    # <editor-fold desc="Data connections of the .mapx documents are changed in copies, without arcpy">
+    if rewrite_mapx:
+        rewrite_service_documents([x for x in subset_transfer_services if x.type == 'MapServer'],
+                                  os.path.join(root, '_mapx'))
+    # </editor-fold>
+
+    # <editor-fold desc="Map services sharing map document and target connection are published from the same map">
+    work = group_map_services([x for x in subset_transfer_services if x.type == 'MapServer' and x.transferred])
+    work.extend([[x] for x in subset_transfer_services if x.type != 'MapServer' and x.transferred])
+    # </editor-fold>
+
     counter = 0
-    for s in subset_transfer_services:
-        counter += 1
+    for group in work:
+        counter += len(group)
+        s = group[0]
         print('Service {} type {}'.format(s.qualified_name, s.type))
         print('Service processed {}/{}'.format(counter, len(subset_transfer_services)))
         print('')
+        # Room for the files of the group is made before they are staged
+        store.enforce_quota(store.expected_bytes(group))
         if s.type == 'MapServer':
-            processing_mapservice(arcgis_proj, s, dummy_name=prefix_service_name)
+            processing_mapservice_group(arcgis_proj, group, dummy_name=prefix_service_name)
         elif s.type == 'GeocodeServer':
             processing_geocode_service(s,  dummy_name=prefix_service_name)
+        elif s.type == 'GPServer':
+            processing_geoprocessing_service(s, dummy_name=prefix_service_name)
+
+        # Files of services already uploaded are removed when the workspace is over the quota
+        store.register_services(group)
+        store.enforce_quota()
+
+    # <editor-fold desc="Capacity settings not included in the sddraft are applied through the admin API">
+    map_services = [x for x in subset_transfer_services if x.type == 'MapServer']
+    if target_servers:
+        # Each target federated in the target portal gets the settings of the services uploaded to it
+        for target, server in target_admin_servers(target_gis.admin.servers.list(), target_servers).items():
+            apply_capacity_profiles_server(server, map_services, prefix_service_name, target=target)
+    else:
+        apply_capacity_profiles_server(target_server, map_services, prefix_service_name)
+    # </editor-fold>
     report_to_csv(source_service, report_output)
+    if target_servers:
+        report_targets_to_csv(source_service, os.path.splitext(report_output)[0] + '_targets.csv')
 
 
 if __name__ == '__main__':
@@ -137,4 +187,9 @@ if __name__ == '__main__':
          root_to='D:\\workspace\\services_uat_to_dev\\COPY_UAT',
          server_connection_file='D:\\workspace\\server_connection_file\\DEV_SERVER.ags',
          list_service_to_copy='D:\\workspace\\services_uat_to_dev\\control_task_services.csv',
-         delete=False)
+         delete=False,
+         capacity_scale=1.0,
+         max_instances=None,
+         target_servers=None,
+         workspace_quota=None,
+         rewrite_mapx=True)
@@ -1,14 +1,30 @@
-import arcgis
-import arcpy
 import os
 import logging
+from arcser_admin.cache import processing_cache
+from arcser_admin.artifacts import ArtifactStore
+from arcser_admin.sessions import session_manager
+from arcser_admin.capacity import scale_capacity_profile, apply_capacity_profiles_server, target_admin_servers
+from arcser_admin.verification import verify_services
+from arcser_admin.engine import WorkerPool, WorkerLimits
+from arcser_admin.metrics import MigrationMetrics
+from arcser_admin.connections import connection_validator
+from arcser_admin.mapx import rewrite_service_documents
+from arcser_admin.inventory import inventory, save_inventory
+from arcser_admin.planner import plan_batches, capacity_plan
+from arcser_admin.workers import init_publishing_worker, publish_group, close_publishing_worker, STAGE_TIMEOUTS, \
+    create_workers_folder, remove_workers_folder, remaining_group
 from arcser_admin.services import create_service_transporter, difference_in_service_list, service_document_path,\
-    processing_mapservice, report_to_csv, processing_geocode_service
+    group_map_services, report_to_csv, report_targets_to_csv
 
 
 def main(portal_source, user_source, password_source, portal_target, user_target, password_target, services_folder_path,
          source_connection, target_connection, worksapce, arcgis_project, prefix_service_name, default_folder,
-         report_output, root_from, root_to, server_connection_file):
+         report_output, root_from, root_to, server_connection_file, capacity_scale=1.0, max_instances=None,
+         cache_root_from=None, cache_root_to=None, link_cache=False, source_server_url=None, target_server_url=None,
+         target_servers=None, workspace_quota=None, max_worker_rss=None, max_worker_handles=None,
+         max_worker_tasks=None, stage_timeouts=None, metrics_file=None, metrics_port=None,
+         rewrite_mapx=True, inventory_output=None, target_machine_memory_mb=None, capacity_headroom=0.8,
+         batch_memory_mb=None):
     """
     :param portal_source: portal source to copy the data
     :param user_source: user of portal source
@@ -27,68 +43,220 @@ def main(portal_source, user_source, password_source, portal_target, user_target
     :param root_from: original root of loc files
     :param root_to: target root loc files
     :param server_connection_file: path to server connection file
+    :param capacity_scale: factor applied to the instances of the source services in the target environment
+    :param max_instances: maximum instances per node allowed in the target environment
+    :param cache_root_from: cache directory of source server. If it is passed the tiles of cached services are transferred
+    :param cache_root_to: cache directory of target server
+    :param link_cache: create hard-links for the tiles instead of copies
+    :param source_server_url: url of source server (https://host:6443/arcgis) to compare the latency of the services
+    :param target_server_url: url of target server. If it is passed the published services are warmed up and verified
+    :param target_servers: List of federated server urls or server connection files, or dictionaries with the server
+    and its own target_data ({'server': url, 'target_data': connection}). If it is passed each service is staged once
+    for each distinct connection and federated server and uploaded to the servers using them. The capacity settings
+    and the verification are applied to each federated server
+    :param workspace_quota: Maximum bytes used by sddraft and sd files in the workspace, None for no limit
+    :param max_worker_rss: resident memory in bytes after which the worker is recycled, None for no limit
+    :param max_worker_handles: open handles after which the worker is recycled, None for no limit
+    :param max_worker_tasks: tasks after which the worker is recycled, None for no limit
+    :param stage_timeouts: dictionary with the maximum seconds of each stage (import, connection, sddraft, stage,
+    upload). The services going over it are marked as not transferred with a timeout comment
+    :param metrics_file: .prom file updated with the progress of the run for the node exporter textfile collector
+    :param metrics_port: port where the progress of the run is published in /metrics, None for no http server
+    :param rewrite_mapx: rewrite the data connections of the .mapx documents before publishing instead of changing
+    them layer by layer in the imported maps
+    :param inventory_output: path without extension of the parquet files with the services and extensions of both
+    servers, None for no inventory
+    :param target_machine_memory_mb: memory in MB of each machine of the target site. If it is passed the load of the
+    services is compared with the load of the target and the services that do not fit are deferred (not transferred)
+    :param capacity_headroom: part of the memory of the target machines the services can use
+    :param batch_memory_mb: memory in MB by machine added by each batch of the capacity plan. The batches are published
+    one after the other and the capacity settings of a batch are applied before the next one starts. None for a single
+    batch
     :return:
     """
 
     # <editor-fold desc="Creation of the arcgis.GIS instances">
-    source_gis = arcgis.gis.GIS(portal_source, user_source, password_source)
-    target_gis = arcgis.gis.GIS(portal_target, user_target, password_target)
+    source_gis = session_manager.gis(portal_source, user_source, password_source)
+    target_gis = session_manager.gis(portal_target, user_target, password_target)
     # </editor-fold>
 
-    # <editor-fold desc="Getting the servers
-    source_server = source_gis.admin.servers.list()[0]
-    target_server = target_gis.admin.servers.list()[0]
-    # </editor-folder>
+    # <editor-fold desc="The worker starts first, it boots while the services are prepared">
+    # The services are published by a worker process, replaced by a new one when it goes over the limits
+    workers_folder = create_workers_folder()
+    # Workers and copies of the project are removed whatever happens from here
+    pool = None
+    try:
+        pool = WorkerPool(1, publish_group, init_publishing_worker, (arcgis_project, workers_folder, prefix_service_name),
+                          close_publishing_worker, WorkerLimits(max_worker_rss, max_worker_handles, max_worker_tasks),
+                          stage_timeouts=stage_timeouts, remaining=remaining_group)
+        pool.start()
+        # </editor-fold>
 
-    # <editor-fold desc="Get the list of ServiceTransporter. Only the Mapservers are loaded">
-    source_service = create_service_transporter(source_server, 'MapServer', 'GeocodeServer')
-    target_service = create_service_transporter(target_server, 'MapServer', 'GeocodeServer')
-    # </editor-fold>
+        # <editor-fold desc="Getting the servers
+        source_server = source_gis.admin.servers.list()[0]
+        target_server = target_gis.admin.servers.list()[0]
+        # </editor-folder>
 
-    # <editor-fold desc="Only the ones no in the target service are selected">
-    transfer_services = difference_in_service_list(source_service, target_service)
-    # </editor-fold>
+        # <editor-fold desc="Get the list of ServiceTransporter. Only the Mapservers are loaded">
+        source_service = create_service_transporter(source_server, 'MapServer', 'GeocodeServer', 'GPServer')
+        target_service = create_service_transporter(target_server, 'MapServer', 'GeocodeServer', 'GPServer')
+        # </editor-fold>
 
-    logging.debug('Services for transfer {}'.format(len(transfer_services)))
-    service_document_path([x for x in transfer_services if x.transferred], services_folder_path, *['.mapx', '.mxd', '.loc'])
+        if inventory_output:
+            save_inventory(*inventory({'source': source_service, 'target': target_service}), inventory_output)
 
-    subset_transfer_services = [x for x in transfer_services if x.transferred]
+        # <editor-fold desc="Only the ones no in the target service are selected">
+        transfer_services = difference_in_service_list(source_service, target_service)
+        # </editor-fold>
 
-    for serv in subset_transfer_services:
-        if serv.type == 'GeocodeServer':
-            serv.server_connection_file = server_connection_file
-            serv.from_root = root_from
-            serv.to_root = root_to
-        if serv.type == 'MapServer':
-            serv.source_data = source_connection
-            serv.target_data = target_connection
+        logging.debug('Services for transfer {}'.format(len(transfer_services)))
+        service_document_path([x for x in transfer_services if x.transferred], services_folder_path, *['.mapx', '.mxd', '.loc', '.rlt'])
 
-    root = worksapce
+        subset_transfer_services = [x for x in transfer_services if x.transferred]
 
-    # <editor-fold desc="Creation of directories">
-    for serv in subset_transfer_services:
-        serv.sddraft_file = os.path.join(root, serv.qualified_name, serv.name + '.sddraft')
-        serv.sd_file = os.path.join(root, serv.qualified_name, serv.name + '.sd')
-        os.makedirs(os.path.join(root, serv.qualified_name), exist_ok=True)
-    # </editor-fold>
+        for serv in subset_transfer_services:
+            if target_servers:
+                serv.targets = list(target_servers)
+            if serv.type == 'GeocodeServer':
+                serv.server_connection_file = server_connection_file
+                serv.from_root = root_from
+                serv.to_root = root_to
+            if serv.type == 'GPServer':
+                serv.server_connection_file = server_connection_file
+            if serv.type == 'MapServer':
+                serv.source_data = source_connection
+                serv.target_data = target_connection
+                serv.capacity_profile = scale_capacity_profile(serv.capacity_profile, capacity_scale, max_instances)
+
+        # <editor-fold desc="Capacity plan: the services that do not fit in the target site are left for a next run">
+        batches = [subset_transfer_services]
+        if target_machine_memory_mb:
+            batches, deferred = plan_batches(subset_transfer_services, target_service, target_machine_memory_mb,
+                                             capacity_headroom, batch_memory_mb)
+            for serv in deferred:
+                serv.transferred = False
+                serv.transferred_comment = 'Capacity planning: deferred, not enough memory in the target machines'
+            logging.info('Capacity plan: {} services planned in {} batches, {} deferred'.format(
+                len(subset_transfer_services) - len(deferred), len(batches), len(deferred)))
+            # The planned services fit with their minimum instances, the overcommit of the maximum ones is logged
+            capacity_plan([x for batch in batches for x in batch], target_service, target_machine_memory_mb,
+                          capacity_headroom)
+            # The services are published in the order of the plan
+            subset_transfer_services = [x for batch in batches for x in batch] + deferred
+        # </editor-fold>
+
+        root = worksapce
+
+        # <editor-fold desc="Creation of directories">
+        store = ArtifactStore(root, workspace_quota)
+        for serv in subset_transfer_services:
+            store.prepare(serv)
+        # </editor-fold>
+
+        if default_folder:
+            for x in subset_transfer_services:
+                x.folder = default_folder
+
+        # <editor-fold desc="Each distinct target connection is tested once, services with unusable ones are not published">
+        connection_validator.validate(subset_transfer_services)
+        # </editor-fold>
+
+        # <editor-fold desc="Data connections of the .mapx documents are changed in copies, without arcpy">
+        if rewrite_mapx:
+            rewrite_service_documents([x for x in subset_transfer_services if x.type == 'MapServer'],
+                                      os.path.join(root, '_mapx'))
+        # </editor-fold>
+
+        # Targets federated in the target portal, the capacity and the verification are applied to each of them
+        federated = target_admin_servers(target_gis.admin.servers.list(), target_servers) if target_servers else {}
+
+        def apply_capacity(services):
+            # Capacity settings not included in the sddraft are applied through the admin API
+            map_services = [x for x in services if x.type == 'MapServer']
+            if target_servers:
+                for target, server in federated.items():
+                    apply_capacity_profiles_server(server, map_services, prefix_service_name, target=target)
+            else:
+                apply_capacity_profiles_server(target_server, map_services, prefix_service_name)
 
-    if default_folder:
-        for x in subset_transfer_services:
-            x.folder = default_folder
+        metrics = MigrationMetrics(len(subset_transfer_services))
+        metrics.services_finished([x for x in subset_transfer_services if not x.transferred])
+        metrics_server = metrics.serve(metrics_port) if metrics_port is not None else None
+        metrics_writer = metrics.write_textfile_periodically(metrics_file) if metrics_file else None
 
-    arcgis_proj = arcpy.mp.ArcGISProject(arcgis_project)
+        def listener(event, task_id, value=None):
+            # Room for the files of a group is made before it is sent to the worker to be staged
+            if event == 'start':
+                store.enforce_quota(store.expected_bytes(work[task_id]))
+            metrics.pool_listener(event, task_id, value)
 
-    counter = 0
-    for s in subset_transfer_services:
-        counter += 1
-        print('Service type {}'.format(s.type))
-        print('Service processed {}/{}'.format(counter, len(subset_transfer_services)))
+        pool.listener = listener
+        for number, batch in enumerate(batches, 1):
+            # <editor-fold desc="Map services sharing map document and target connection are published together">
+            work = group_map_services([x for x in batch if x.type == 'MapServer' and x.transferred])
+            work.extend([[x] for x in batch if x.type != 'MapServer' and x.transferred])
+            # </editor-fold>
 
-        if s.type == 'MapServer':
-            processing_mapservice(arcgis_proj, dummy_name=prefix_service_name)
-        elif s.type == 'GeocodeServer':
-            processing_geocode_service(s,  dummy_name=prefix_service_name)
+            for group, result, error in pool.run(work):
+                # The worker returns a copy of the services with the result of the process. If the group has not
+                # finished the services processed before the error keep their result and the rest get the error
+                processed = {returned.qualified_name: returned for returned, elapsed in result}
+                for x in group:
+                    if x.qualified_name in processed:
+                        x.update(processed[x.qualified_name])
+                    elif error:
+                        x.transferred = False
+                        x.transferred_comment = error
+
+                # Files of services already uploaded are removed when the workspace is over the quota
+                # The uploaded bytes are measured before the sd files can be removed
+                metrics.services_finished(group)
+                print('Service type {}'.format(group[0].type))
+                print(metrics.summary())
+
+                store.register_services(group)
+                store.enforce_quota()
+
+            # Each batch adds at most batch_memory_mb by machine, its capacity settings are applied before the next one
+            if len(batches) > 1:
+                apply_capacity(batch)
+                logging.info('Capacity plan: batch {}/{} published'.format(number, len(batches)))
+    finally:
+        # Copies of the project left by killed workers are removed too
+        if pool is not None:
+            pool.close()
+        remove_workers_folder(workers_folder)
+
+    if metrics_server:
+        metrics_server.shutdown()
+    if metrics_writer:
+        metrics_writer.set()
+
+    # <editor-fold desc="Capacity settings not included in the sddraft are applied through the admin API">
+    if len(batches) == 1:
+        apply_capacity(subset_transfer_services)
+    # </editor-fold>
+
+    # <editor-fold desc="Transfer of the tiles of cached services">
+    if cache_root_from and cache_root_to:
+        for s in [x for x in subset_transfer_services if x.type == 'MapServer']:
+            processing_cache(s, cache_root_from, cache_root_to, dummy_name=prefix_service_name, link=link_cache)
+    # </editor-fold>
+
+    # <editor-fold desc="Warm up and latency verification of the published services">
+    if target_servers:
+        for target in federated:
+            verify_services(subset_transfer_services, target, source_server_url, dummy_name=prefix_service_name,
+                            target_token=session_manager.ticket(portal_target, user_target).token,
+                            source_token=session_manager.ticket(portal_source, user_source).token, target=target)
+    elif target_server_url:
+        verify_services(subset_transfer_services, target_server_url, source_server_url, dummy_name=prefix_service_name,
+                        target_token=session_manager.ticket(portal_target, user_target).token,
+                        source_token=session_manager.ticket(portal_source, user_source).token)
+    # </editor-fold>
     report_to_csv(source_service, report_output)
+    if target_servers:
+        report_targets_to_csv(source_service, os.path.splitext(report_output)[0] + '_targets.csv')
 
 
 if __name__ == '__main__':
@@ -108,5 +276,25 @@ if __name__ == '__main__':
          report_output='',
          root_from='',
          root_to='',
-         server_connection_file='')
+         server_connection_file='',
+         capacity_scale=1.0,
+         max_instances=None,
+         cache_root_from=None,
+         cache_root_to=None,
+         link_cache=False,
+         source_server_url=None,
+         target_server_url=None,
+         target_servers=None,
+         workspace_quota=None,
+         max_worker_rss=None,
+         max_worker_handles=None,
+         max_worker_tasks=None,
+         stage_timeouts=STAGE_TIMEOUTS,
+         metrics_file=None,
+         metrics_port=None,
+         rewrite_mapx=True,
+         inventory_output=None,
+         target_machine_memory_mb=None,
+         capacity_headroom=0.8,
+         batch_memory_mb=None)
 
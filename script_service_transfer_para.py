@@ -1,26 +1,25 @@
-import arcgis
-import arcpy
 from arcser_admin.services import create_service_transporter, difference_in_service_list, service_document_path, \
-    processing_mapservice, report_to_csv
-from arcser_admin.helpers import slicer
-import tempfile
-import shutil
-from multiprocessing import Pool
-import os
+    group_map_services, report_to_csv
+from arcser_admin.artifacts import ArtifactStore
+from arcser_admin.engine import WorkerPool, WorkerLimits
+from arcser_admin.metrics import MigrationMetrics
+from arcser_admin.connections import connection_validator
+from arcser_admin.mapx import rewrite_service_documents
+from arcser_admin.sessions import session_manager
+from arcser_admin.retry import rate_bucket
+from arcser_admin.scheduling import load_timings, save_timings, order_by_cost, order_groups_by_cost
+from arcser_admin.workers import init_publishing_worker, publish_group, close_publishing_worker, STAGE_TIMEOUTS, \
+    create_workers_folder, remove_workers_folder, remaining_group
+from multiprocessing import BoundedSemaphore
 import logging
-
-
-def create_service_dec(project, portal, user, password, slice_):
-        arcgis_proj = arcpy.mp.ArcGISProject(project)
-        my_gis = arcgis.GIS(portal, user, password)
-        server = my_gis.admin.servers.list()[0]
-        for s in slice_:
-            processing_mapservice(arcgis_proj)
+import os
 
 
 def main(portal_source, user_source, password_source, portal_target, user_target, password_target, services_folder_path,
          source_connection, target_connection, workspace, default_folder, report_output, temps_folder,
-         arc_proj_template):
+         arc_proj_template, max_concurrent_uploads=2, uploads_per_minute=None, timings_file=None,
+         workspace_quota=None, max_worker_rss=None, max_worker_handles=None, max_worker_tasks=None,
+         stage_timeouts=None, metrics_file=None, metrics_port=None, rewrite_mapx=True):
     """
     :param portal_source: Portal source to copy the data
     :param user_source: User of portal source
@@ -36,57 +35,124 @@ def main(portal_source, user_source, password_source, portal_target, user_target
     :param report_output: CSV for report
     :param temps_folder: Path to temp folder where to
     :param arc_proj_template: Template arcgis project
+    :param max_concurrent_uploads: Uploads to target server running at the same time for all the workers
+    :param uploads_per_minute: Uploads to target server started per minute by all the workers, None for no limit
+    :param timings_file: Json file with the seconds spent by each service in previous runs. It is updated at the end
+    :param workspace_quota: Maximum bytes used by sddraft and sd files in the workspace, None for no limit
+    :param max_worker_rss: Resident memory in bytes after which a worker is recycled, None for no limit
+    :param max_worker_handles: Open handles after which a worker is recycled, None for no limit
+    :param max_worker_tasks: Tasks after which a worker is recycled, None for no limit
+    :param stage_timeouts: Dictionary with the maximum seconds of each stage (import, connection, sddraft, stage,
+    upload). The services going over it are marked as not transferred with a timeout comment
+    :param metrics_file: .prom file updated with the progress of the run for the node exporter textfile collector
+    :param metrics_port: Port where the progress of the run is published in /metrics, None for no http server
+    :param rewrite_mapx: Rewrite the data connections of the .mapx documents before publishing instead of changing
+    them layer by layer in the imported maps
     :return:
     """
 
-    source_gis = arcgis.gis.GIS(portal_source, user_source, password_source)
-    target_gis = arcgis.gis.GIS(portal_target, user_target, password_target)
-
-    # get first the services
-    source_server = source_gis.admin.servers.list()[0]
-    target_server = target_gis.admin.servers.list()[0]
-
-    source_service = create_service_transporter(source_server, 'MapServer')
-    target_service = create_service_transporter(target_server, 'MapServer')
-
-    transfer_services = difference_in_service_list(source_service, target_service)
-
-    logging.debug('Services for transfer {}'.format(len(transfer_services)))
-
-    service_document_path(transfer_services, services_folder_path, *['.mapx', '.mxd'])
-
-    subset_transfer_services = [x for x in transfer_services if x.transferred]
-
-    with Pool(4) as p:
-
-        tasks = []
-
-        for slice_ in slicer(subset_transfer_services, 20):
-            for serv in slice_:
-                serv.source_data = source_connection
-                serv.target_data = target_connection
-
-            root = workspace
-
-            for serv in subset_transfer_services:
-                serv.sddraft_file = os.path.join(root, serv.qualified_name, serv.name + '.sddraft')
-                serv.sd_file = os.path.join(root, serv.qualified_name, serv.name + '.sd')
-                os.makedirs(os.path.join(root, serv.qualified_name), exist_ok=True)
-
+    source_gis = session_manager.gis(portal_source, user_source, password_source)
+    target_gis = session_manager.gis(portal_target, user_target, password_target)
+
+    # <editor-fold desc="Workers start first, they boot while the services are prepared">
+    # Workers over the limits are replaced by new ones with a fresh copy of the project
+    upload_semaphore = BoundedSemaphore(max_concurrent_uploads)
+    upload_bucket = rate_bucket(uploads_per_minute, shared=True) if uploads_per_minute else None
+    workers_folder = create_workers_folder(temps_folder)
+    # Workers and copies of the project are removed whatever happens from here
+    pool = None
+    try:
+        pool = WorkerPool(4, publish_group, init_publishing_worker,
+                          (arc_proj_template, workers_folder, '', portal_target, user_target, password_target,
+                           upload_semaphore, upload_bucket),
+                          close_publishing_worker, WorkerLimits(max_worker_rss, max_worker_handles, max_worker_tasks),
+                          stage_timeouts=stage_timeouts, semaphores={'upload': upload_semaphore},
+                          remaining=remaining_group)
+        pool.start()
+        # </editor-fold>
+
+        # get first the services
+        source_server = source_gis.admin.servers.list()[0]
+        target_server = target_gis.admin.servers.list()[0]
+
+        source_service = create_service_transporter(source_server, 'MapServer')
+        target_service = create_service_transporter(target_server, 'MapServer')
+
+        transfer_services = difference_in_service_list(source_service, target_service)
+
+        logging.debug('Services for transfer {}'.format(len(transfer_services)))
+
+        service_document_path(transfer_services, services_folder_path, *['.mapx', '.mxd'])
+
+        subset_transfer_services = [x for x in transfer_services if x.transferred]
+
+        store = ArtifactStore(workspace, workspace_quota)
+        for serv in subset_transfer_services:
+            serv.source_data = source_connection
+            serv.target_data = target_connection
+            store.prepare(serv)
             if default_folder:
-                for x in subset_transfer_services:
-                    x.folder = default_folder
-
-            temp_folder = tempfile.mkdtemp(dir=temps_folder)
-            shutil.copy2(arc_proj_template, os.path.join(temp_folder, 'arcgis_proj.aprx'))
-
-            pro = os.path.join(temp_folder, 'arcgis_proj.aprx')
-            task = p.apply_async(create_service_dec, (pro, portal_target, user_target, password_target, slice_))
-            tasks.append(task)
-
-        for task in tasks:
-            task.wait()
-            logging.debug('Task is done {}'.format(task.get()))
+                serv.folder = default_folder
+
+        # Each distinct target connection is tested once, services with unusable ones are not published
+        connection_validator.validate(subset_transfer_services)
+
+        # Data connections of the .mapx documents are changed in copies, without arcpy
+        if rewrite_mapx:
+            rewrite_service_documents(subset_transfer_services, os.path.join(workspace, '_mapx'))
+
+        # <editor-fold desc="Services are dispatched one by one (or by group sharing map), the most expensive first">
+        # The groups are ordered by the cost of all their services, a big group sharing a document goes first
+        previous_timings = load_timings(timings_file)
+        ordered_groups = order_groups_by_cost(
+            group_map_services(order_by_cost([x for x in subset_transfer_services if x.transferred], previous_timings)),
+            previous_timings)
+        timings = {}
+        services = {x.qualified_name: x for x in transfer_services}
+        metrics = MigrationMetrics(len(subset_transfer_services))
+        metrics.services_finished([x for x in subset_transfer_services if not x.transferred])
+        metrics_server = metrics.serve(metrics_port) if metrics_port is not None else None
+        metrics_writer = metrics.write_textfile_periodically(metrics_file) if metrics_file else None
+
+        def listener(event, task_id, value=None):
+            # Room for the files of a group is made before it is sent to a worker to be staged
+            if event == 'start':
+                store.enforce_quota(store.expected_bytes(ordered_groups[task_id]))
+            metrics.pool_listener(event, task_id, value)
+
+        pool.listener = listener
+        for group, result, error in pool.run(ordered_groups):
+            # The workers return a copy of the services with the result of the process. If the group has not finished
+            # only the services processed before the error are returned
+            for serv, elapsed in result:
+                services[serv.qualified_name].update(serv)
+                if serv.transferred:
+                    timings[serv.qualified_name] = elapsed
+                    logging.debug('Service {} done in {:.1f}s'.format(serv.qualified_name, elapsed))
+            processed = {serv.qualified_name for serv, _ in result}
+            # The rest of the services get the error, they have no real timing so the one of a previous run is kept
+            for serv in group:
+                if error and serv.qualified_name not in processed:
+                    services[serv.qualified_name].transferred = False
+                    services[serv.qualified_name].transferred_comment = error
+            # The uploaded bytes are measured before the sd files can be removed
+            metrics.services_finished([services[serv.qualified_name] for serv in group])
+            logging.info(metrics.summary())
+            store.register_services([services[serv.qualified_name] for serv in group])
+            store.enforce_quota()
+    finally:
+        # Copies of the project left by killed workers are removed too
+        if pool is not None:
+            pool.close()
+        remove_workers_folder(workers_folder)
+    if metrics_server:
+        metrics_server.shutdown()
+    if metrics_writer:
+        metrics_writer.set()
+    # </editor-fold>
+
+    if timings_file:
+        save_timings(timings_file, timings)
 
     report_to_csv(transfer_services, report_output)
 
@@ -105,4 +171,15 @@ if __name__ == '__main__':
          default_folder='',
          report_output='',
          temps_folder='',
-         arc_proj_template='')
+         arc_proj_template='',
+         max_concurrent_uploads=2,
+         uploads_per_minute=None,
+         timings_file=None,
+         workspace_quota=None,
+         max_worker_rss=None,
+         max_worker_handles=None,
+         max_worker_tasks=None,
+         stage_timeouts=STAGE_TIMEOUTS,
+         metrics_file=None,
+         metrics_port=None,
+         rewrite_mapx=True)
@@ -0,0 +1,73 @@
+import json
+import os
+import unittest
+from types import SimpleNamespace
+from arcser_admin.capacity import capacity_profile, geoprocessing_settings, target_admin_servers
+
+
+DATA = os.path.join(os.path.dirname(__file__), 'data')
+
+
+def lowercase_keys(value):
+    """ Same conversion as services.regular_dict for the json of the admin API """
+    if isinstance(value, dict):
+        return {k.lower(): lowercase_keys(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [lowercase_keys(v) for v in value]
+    return value
+
+
+def load_admin_json(name):
+    with open(os.path.join(DATA, name), 'r') as f:
+        return lowercase_keys(json.load(f))
+
+
+class GeoprocessingSettingsTest(unittest.TestCase):
+
+    def test_admin_json(self):
+        settings = geoprocessing_settings(load_admin_json('gp_service_admin.json'))
+        self.assertEqual(settings, {'executionType': 'Asynchronous', 'resultMapServer': False,
+                                    'showMessages': 'WARNING', 'maximumRecords': 2000, 'minInstances': 1,
+                                    'maxInstances': 4, 'maxUsageTime': 1200, 'maxWaitTime': 60,
+                                    'maxIdleTime': 1800})
+
+    def test_synchronous(self):
+        properties = load_admin_json('gp_service_admin.json')
+        properties['properties']['executiontype'] = 'Synchronous'
+        self.assertEqual(geoprocessing_settings(properties)['executionType'], 'Synchronous')
+
+    def test_defaults(self):
+        settings = geoprocessing_settings({'properties': {}})
+        self.assertEqual(settings['executionType'], 'Synchronous')
+        self.assertEqual(settings['showMessages'], 'INFO')
+
+
+class CapacityProfileTest(unittest.TestCase):
+
+    def test_admin_json(self):
+        profile = capacity_profile(load_admin_json('gp_service_admin.json'))
+        self.assertEqual(profile['minInstancesPerNode'], 1)
+        self.assertEqual(profile['maxInstancesPerNode'], 4)
+        self.assertEqual(profile['isolationLevel'], 'HIGH')
+
+
+class TargetAdminServersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = [SimpleNamespace(url='https://dev.example.org:6443/arcgis/admin'),
+                        SimpleNamespace(url='https://uat.example.org:6443/arcgis/admin')]
+
+    def test_urls_and_dictionaries(self):
+        targets = ['https://DEV.example.org:6443/arcgis/',
+                   {'server': 'https://uat.example.org:6443/arcgis', 'target_data': {'database': 'uat'}}]
+        result = target_admin_servers(self.servers, targets)
+        self.assertEqual(result, {'https://DEV.example.org:6443/arcgis/': self.servers[0],
+                                  'https://uat.example.org:6443/arcgis': self.servers[1]})
+
+    def test_not_federated(self):
+        targets = [r'D:\connections\prod.ags', 'https://prod.example.org:6443/arcgis']
+        self.assertEqual(target_admin_servers(self.servers, targets), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
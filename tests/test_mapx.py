@@ -0,0 +1,96 @@
+import os
+import shutil
+import tempfile
+import unittest
+from arcser_admin.mapx import parse_connection_string, format_connection_string, load_mapx, data_connections, \
+    rewrite_mapx, rewrite_service_documents
+
+
+DATA = os.path.join(os.path.dirname(__file__), 'data')
+MAPX = os.path.join(DATA, 'parcels.mapx')
+
+TARGET_CONNECTION = {'connection_info': {'server': 'gisdb02', 'instance': 'sde:sqlserver:gisdb02',
+                                         'db_connection_properties': 'gisdb02', 'user': 'gis_publisher',
+                                         'encrypted_password': '00022e68714e7a4b4e6b4a3d2a00',
+                                         'authentication_mode': 'DBMS', 'database': 'Ignored',
+                                         'version': 'Ignored'}}
+
+
+def connection_string(path=MAPX):
+    return next(data_connections(load_mapx(path)))['workspaceConnectionString']
+
+
+class FormatConnectionStringTest(unittest.TestCase):
+
+    def test_parse(self):
+        info = parse_connection_string(connection_string())
+        self.assertEqual(info['database'], 'Parcels')
+        self.assertEqual(info['version'], 'dbo.DEFAULT')
+        self.assertEqual(info['db_connection_properties'], 'gisdb01\\sqlexpress')
+
+    def test_same_info_same_string(self):
+        original = connection_string()
+        self.assertEqual(format_connection_string(parse_connection_string(original), original), original)
+
+    def test_replace_mapped_keys(self):
+        original = connection_string()
+        info = dict(TARGET_CONNECTION['connection_info'], database='Parcels', version='dbo.DEFAULT')
+        result = parse_connection_string(format_connection_string(info, original))
+        self.assertEqual(result['server'], 'gisdb02')
+        self.assertEqual(result['instance'], 'sde:sqlserver:gisdb02')
+        self.assertEqual(result['user'], 'gis_publisher')
+        self.assertEqual(result['encrypted_password'], '00022e68714e7a4b4e6b4a3d2a00')
+        # Keys not in the connection info are kept
+        self.assertEqual(result['dbclient'], 'sqlserver')
+        self.assertEqual(result['authentication_mode'], 'DBMS')
+        self.assertNotIn('password', result)
+
+    def test_plain_password_not_written(self):
+        original = connection_string()
+        result = format_connection_string({'password': 'secret'}, original)
+        self.assertEqual(result, original)
+
+    def test_operating_system_authentication(self):
+        result = parse_connection_string(format_connection_string({'authentication_mode': 'OSA'},
+                                                                  connection_string()))
+        self.assertEqual(result['authentication_mode'], 'OSA')
+        self.assertNotIn('user', result)
+        self.assertNotIn('encrypted_password', result)
+
+
+class RewriteMapxTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_rewrite(self):
+        output = os.path.join(self.folder, 'parcels.mapx')
+        result = rewrite_mapx(MAPX, output, TARGET_CONNECTION)
+        self.assertIsNone(result['error'])
+        self.assertEqual(result['changed'], 1)
+        info = parse_connection_string(connection_string(output))
+        # Database and version of the layer are kept, as services.change_connection does
+        self.assertEqual(info['database'], 'Parcels')
+        self.assertEqual(info['version'], 'dbo.DEFAULT')
+        self.assertEqual(info['server'], 'gisdb02')
+        self.assertEqual(info['dbclient'], 'sqlserver')
+
+    def test_plain_password_left_to_arcpy(self):
+        class Service:
+            transferred = True
+            map_doc_path = MAPX
+            qualified_name = 'Parcels.MapServer'
+            connection_rewritten = False
+            target_data = {'connection_info': {'server': 'gisdb02', 'user': 'gis', 'password': 'secret'}}
+        service = Service()
+        self.assertEqual(rewrite_service_documents([service], self.folder), [])
+        self.assertTrue(service.transferred)
+        self.assertFalse(service.connection_rewritten)
+        self.assertEqual(service.map_doc_path, MAPX)
+
+
+if __name__ == '__main__':
+    unittest.main()
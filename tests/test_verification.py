@@ -0,0 +1,99 @@
+import json
+import socketserver
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from types import SimpleNamespace
+from arcser_admin.verification import verify_services
+
+
+EXTENT = {'xmin': 0, 'ymin': 0, 'xmax': 100, 'ymax': 100, 'spatialReference': {'wkid': 25830}}
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class RestHandler(BaseHTTPRequestHandler):
+    """ Canned REST responses. The path of the service sets the behaviour: ok, error or slow """
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if '/slow/' in path:
+            time.sleep(self.server.delay)
+        if '/error/' in path and not path.endswith('MapServer'):
+            content = {'error': {'code': 500, 'message': 'Unable to complete operation'}}
+        elif path.endswith('MapServer'):
+            content = {'initialExtent': EXTENT}
+        elif path.endswith('/export'):
+            content = {'href': 'https://localhost/output/map.png', 'width': 400, 'height': 400}
+        else:
+            content = {'results': []}
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def map_service(name):
+    return SimpleNamespace(name=name, folder='verification', qualified_name='verification/{}'.format(name),
+                           type='MapServer', transferred=True, target_results={}, verified=None,
+                           verification_comment=None, latency=None, latency_regressed=None)
+
+
+class VerifyServicesTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = _ThreadingHTTPServer(('127.0.0.1', 0), RestHandler)
+        cls.server.delay = 2
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = 'http://127.0.0.1:{}/arcgis'.format(cls.server.server_address[1])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def verify(self, service, **kwargs):
+        return verify_services([service], self.url, warmup=2, concurrency=1, timeout=1, **kwargs)
+
+    def test_passing(self):
+        service = map_service('ok')
+        regressed = self.verify(service, source_server_url=self.url)
+        self.assertEqual(regressed, [])
+        self.assertTrue(service.verified)
+        self.assertIsNone(service.verification_comment)
+        self.assertIsNotNone(service.latency['target_warm'])
+        self.assertIsNotNone(service.latency['source_warm'])
+        self.assertFalse(service.latency_regressed)
+
+    def test_failing(self):
+        service = map_service('error')
+        self.verify(service)
+        self.assertFalse(service.verified)
+        self.assertIn('Verification error', service.verification_comment)
+        self.assertIn('Unable to complete operation', service.verification_comment)
+
+    def test_timeout(self):
+        service = map_service('slow')
+        self.verify(service)
+        self.assertFalse(service.verified)
+        self.assertIn('Verification error', service.verification_comment)
+        self.assertIn('timed out', service.verification_comment)
+
+    def test_not_transferred(self):
+        service = map_service('ok')
+        service.transferred = False
+        self.verify(service)
+        self.assertIsNone(service.verified)
+
+
+if __name__ == '__main__':
+    unittest.main()